@@ -1,5 +1,7 @@
 from .agent.core import HypothesisAgent
+from .logging_setup import setup_logging
 
 if __name__ == "__main__":
+    setup_logging()
     bot = HypothesisAgent()
     bot.start()
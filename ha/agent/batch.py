@@ -0,0 +1,48 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+from ha.models import async_openai_client as client
+from ha.utils import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# states after which a batch no longer changes
+BATCH_FINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+async def batch_completions(bodies: List[dict], poll_interval: float = 30.0) -> List[Optional[str]]:
+    """
+    Runs chat completion requests through the OpenAI Batch API, which is cheaper than the real-time API but may take
+    up to a day. Only meant for large offline sweeps.
+
+    Args:
+        bodies: The bodies of the chat completion requests, i.e. the keyword arguments of chat.completions.create.
+        poll_interval: The number of seconds between checks of the batch status.
+
+    Returns:
+        The content of each response, in request order; None for the requests that failed.
+    """
+    lines = [dumps({"custom_id": str(i), "method": "POST", "url": BATCH_ENDPOINT, "body": body})
+             for i, body in enumerate(bodies)]
+    batch_file = await client.files.create(file=("batch.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = await client.batches.create(input_file_id=batch_file.id, endpoint=BATCH_ENDPOINT,
+                                        completion_window="24h")
+    logger.info(f"Submitted batch {batch.id} with {len(bodies)} requests.")
+    while batch.status not in BATCH_FINAL_STATES:
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} did not complete: {batch.status}.")
+
+    contents: List[Optional[str]] = [None] * len(bodies)
+    output = await client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        result = loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") == 200:
+            contents[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+        else:
+            logger.error(f"Request {result['custom_id']} of batch {batch.id} failed: {result.get('error')}")
+    return contents
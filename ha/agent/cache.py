@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import numpy as np
+
+from ha import config
+from ha.models import async_openai_client as client
+
+logger = logging.getLogger(__name__)
+
+
+async def openai_embed(text: str, model: str = config.OPENAI_EMBEDDING_MODEL) -> np.ndarray:
+    """
+    Embeds a text using the OpenAI embeddings API.
+
+    Args:
+        text: The text to embed.
+        model: The embedding model to use.
+
+    Returns:
+        The embedding as a float32 vector.
+    """
+    response = await client.embeddings.create(model=model, input=text)
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+
+class SemanticCache:
+    """
+    A local cache of LLM responses keyed by the meaning of the prompt rather than its exact text.
+
+    Entries are persisted in SQLite and searched in memory with an inner product over L2-normalised embeddings
+    (i.e. cosine similarity). Every entry belongs to a scope so that responses generated for one context
+    (model, system prompt) are never served in another. Expired entries, and the oldest ones past maxsize, are
+    evicted as new entries are stored.
+    """
+
+    def __init__(self, path: str = config.SEMANTIC_CACHE_PATH, threshold: float = config.SEMANTIC_CACHE_THRESHOLD,
+                 ttl: int = config.SEMANTIC_CACHE_TTL,
+                 embed: Callable[[str], Awaitable[np.ndarray]] = openai_embed,
+                 maxsize: Optional[int] = config.SEMANTIC_CACHE_MAX_ENTRIES):
+        """
+        Initializes the semantic cache.
+
+        Args:
+            path: The path to the SQLite database; use ':memory:' for a throwaway cache.
+            threshold: The minimum cosine similarity for a cached response to be reused.
+            ttl: The number of seconds a cached response stays valid.
+            embed: An async function that embeds a text into a vector.
+            maxsize: The maximum number of entries kept, or None for no bound.
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.embed = embed
+        self.maxsize = maxsize
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            "prompt_hash TEXT PRIMARY KEY, scope TEXT, embedding BLOB, response TEXT, ts INTEGER, hits INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS semantic_cache_scope ON semantic_cache (scope)")
+        self.db.commit()
+        # scope -> (prompt hashes, matrix of normalised embeddings); loaded from disk on first use
+        self._index: Dict[str, tuple] = {}
+
+    @staticmethod
+    def scope_for(*parts: str) -> str:
+        """
+        Builds a scope key from the parts of the context a response depends on.
+
+        Args:
+            parts: The context parts, e.g. the model name and the system prompt.
+
+        Returns:
+            The scope key.
+        """
+        return hashlib.blake2b('\x00'.join(parts).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _normalise(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _load(self, scope: str) -> tuple:
+        """
+        Loads the unexpired embeddings of a scope into memory.
+
+        Args:
+            scope: The scope key.
+
+        Returns:
+            A tuple of the prompt hashes and a matrix with one normalised embedding per row.
+        """
+        if scope not in self._index:
+            rows = self.db.execute(
+                "SELECT prompt_hash, embedding FROM semantic_cache WHERE scope = ? AND ts >= ?",
+                (scope, int(time.time()) - self.ttl)
+            ).fetchall()
+            hashes = [row[0] for row in rows]
+            matrix = (np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+                      if rows else np.empty((0, 0), dtype=np.float32))
+            self._index[scope] = (hashes, matrix)
+        return self._index[scope]
+
+    async def lookup(self, text: str, scope: str, threshold: Optional[float] = None,
+                     ttl: Optional[int] = None) -> Optional[str]:
+        """
+        Looks up a response for a prompt that is semantically close to the given text.
+
+        Args:
+            text: The prompt text.
+            scope: The scope key, see scope_for.
+            threshold: Overrides the similarity threshold of the cache.
+            ttl: Overrides the time to live of the cache.
+
+        Returns:
+            The cached response or None on a miss.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        ttl = self.ttl if ttl is None else ttl
+        hashes, matrix = self._load(scope)
+        if not hashes:
+            return None
+        vector = self._normalise(await self.embed(text))
+        similarities = matrix @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < threshold:
+            return None
+        row = self.db.execute(
+            "SELECT response FROM semantic_cache WHERE prompt_hash = ? AND ts >= ?",
+            (hashes[best], int(time.time()) - ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE semantic_cache SET hits = hits + 1 WHERE prompt_hash = ?", (hashes[best],))
+        self.db.commit()
+        logger.info(f"Semantic cache hit (similarity {similarities[best]:.3f}).")
+        return row[0]
+
+    async def store(self, text: str, response: str, scope: str):
+        """
+        Stores the response to a prompt.
+
+        Args:
+            text: The prompt text.
+            response: The response to cache.
+            scope: The scope key, see scope_for.
+        """
+        vector = self._normalise(await self.embed(text))
+        prompt_hash = self.scope_for(scope, text)
+        self.db.execute(
+            "INSERT OR REPLACE INTO semantic_cache (prompt_hash, scope, embedding, response, ts, hits) "
+            "VALUES (?, ?, ?, ?, ?, 0)",
+            (prompt_hash, scope, vector.tobytes(), response, int(time.time()))
+        )
+        evicted = self._evict()
+        self.db.commit()
+        if evicted:
+            # the evicted entries may be in any scope; the scopes are reloaded on their next use
+            self._index.clear()
+            return
+        # keep the in-memory index in sync instead of reloading the scope
+        hashes, matrix = self._load(scope)
+        if prompt_hash in hashes:
+            matrix[hashes.index(prompt_hash)] = vector
+        else:
+            hashes.append(prompt_hash)
+            matrix = np.vstack([matrix, vector]) if matrix.size else vector[np.newaxis, :]
+        self._index[scope] = (hashes, matrix)
+
+    def _evict(self) -> int:
+        """
+        Deletes the expired entries and, past maxsize, the oldest ones.
+
+        Returns:
+            The number of entries deleted.
+        """
+        evicted = self.db.execute("DELETE FROM semantic_cache WHERE ts < ?", (int(time.time()) - self.ttl,)).rowcount
+        if self.maxsize is not None:
+            evicted += self.db.execute(
+                "DELETE FROM semantic_cache WHERE prompt_hash NOT IN "
+                "(SELECT prompt_hash FROM semantic_cache ORDER BY ts DESC, rowid DESC LIMIT ?)",
+                (self.maxsize,)
+            ).rowcount
+        return evicted
@@ -1,19 +1,80 @@
-import json
+import asyncio
+import hashlib
 import logging
+import sys
+import uuid
 import warnings
+from collections import deque
+from typing import Optional
+
+import orjson
 
 from ha import config
+from ha.agent.cache import SemanticCache
+from ha.agent.exact_cache import ExactCache, exact_cache
 from ha.agent.executor import QueryExecutor
 from ha.agent.planner import Planner
+from ha.agent.router import KeywordRouter
 from ha.tools.plan import PlanExecutor
-from ha.models import openai_client as client
-from ha.utils import green, blue, print_pretty_tasks
+from ha.models import async_openai_client as client, close_clients
+from ha.utils import build_messages, dumps, json_schema_format, loads, green, blue, print_pretty_tasks
 
 # Set up logging
 warnings.filterwarnings("ignore")
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of times the action choice is tried before falling back to a direct answer; the structured output
+# guarantees a valid action, so a retry would only repeat the same request
+MAX_RETRY = 1
+
+# Number of plan analyses kept per session
+ANALYSIS_CACHE_SIZE = 32
+
+# Prompts; the system messages are shared objects so that every request starts with the same bytes
+RESPONSE_SYSTEM_MESSAGE = {"role": "system", "content": "You are a system that generates responses to user input."}
+
+ACTION_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that makes decisions and responds with JSON. "
+               "Given a conversation history and the latest user input, choose the "
+               "best action to take next, focus on the later part of the conversation:\n"
+               "1. answer -- choose this if the question is NOT in the biomedical "
+               "domain, related to genes, KEGG or GAF data.\n"
+               "2. ask -- ask a follow-up question; choose if you think you need more "
+               "information; max 3 follow-ups.\n"
+               "3. agent -- choose if the question is related to biomedical domain, "
+               "KEGG or GAF data and analysis.\n"
+               "Respond with the following JSON: "
+               "{'action': '<action here: answer/ask/agent>'}"
+}
+ACTION_FORMAT = json_schema_format("action", {"action": {"type": "string", "enum": ["answer", "ask", "agent"]}})
+ACTION_PROMPT = "Conversation History:\n{history}\nAnd user input: {user_input}\n"
+
+FOLLOW_UP_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates follow-up questions. Given the user "
+               "input, generate a follow-up question to get more information."
+}
+FOLLOW_UP_PROMPT = "User input: {user_input}"
+
+HYPOTHESIS_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates hypotheses based on analysis results. "
+               "Given the original conversation, the analysis objective and the "
+               "analysis results, generate an appropriate hypothesis. Include any "
+               "relevant information from the analysis, especially names of genes, "
+               "any counts, values and other useful data."
+}
+HYPOTHESIS_PROMPT = "Conversation: {conversation}\nObjective: {objective}\nAnalysis results: {analysis}\n"
+
+SUMMARY_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that compresses conversations. Given a conversation "
+               "and the summary of what came before it, compress both into a "
+               "one-sentence summary. Keep names of genes, pathways and other "
+               "specific details."
+}
+SUMMARY_PROMPT = "Previous summary: {summary}\nConversation:\n{conversation}"
 
 
 class HypothesisAgent:
@@ -24,13 +85,32 @@ class HypothesisAgent:
         Args:
             model: The model to use for the user interactions.
         """
-        self.conversation_history = [
-            {"role": "system", "content": "You are a system that generates responses to user input."}
-        ]
+        self.conversation_history = deque(maxlen=config.MAX_HISTORY)
+        # one-sentence summary of the turns that were evicted from the history
+        self._summary = None
+        # serialised views of the history, maintained on append instead of being rebuilt every turn
+        self._history_json_cache = bytearray(b'[]')
+        self._conversation_lines = []
+        self._reset_history()
         self.model = model
+        # stable per conversation; lets OpenAI route repeated prefixes to the same prompt cache
+        self.session_id = uuid.uuid4().hex
         self.planner = Planner(model=model)
         self.plan_executor = PlanExecutor(model=model)
         self.query_executor = QueryExecutor(model=model)
+        self.cache = SemanticCache() if config.SEMANTIC_CACHE else None
+        self.router = KeywordRouter() if config.KEYWORD_ROUTER else None
+        # plan hash -> analysis; a rephrased question often leads to the same plan
+        self._analysis_cache = ExactCache(maxsize=ANALYSIS_CACHE_SIZE)
+        # objective -> analysis, for near-duplicate objectives; kept in memory for the life of the agent, since an
+        # analysis reflects this session's conversation
+        self._similar_analyses = (SemanticCache(path=':memory:', maxsize=ANALYSIS_CACHE_SIZE)
+                                  if config.SEMANTIC_CACHE else None)
+        self._actions = {
+            "answer": self.get_response,
+            "ask": self.ask_follow_up,
+            "agent": self.ask_ha,
+        }
 
     @staticmethod
     def ha_says(message: str):
@@ -42,6 +122,27 @@ class HypothesisAgent:
         """
         print(blue('\n\nha: ') + message)
 
+    @staticmethod
+    async def ha_streams(stream) -> str:
+        """
+        Print a streamed message from the HA as it arrives.
+
+        Args:
+            stream: The streamed chat completion.
+
+        Returns:
+            The full message.
+        """
+        sys.stdout.write(blue('\n\nha: '))
+        chunks = []
+        async for event in stream:
+            delta = (event.choices[0].delta.content or '') if event.choices else ''
+            sys.stdout.write(delta)
+            sys.stdout.flush()
+            chunks.append(delta)
+        sys.stdout.write('\n')
+        return ''.join(chunks)
+
     @staticmethod
     def user_says():
         """
@@ -52,10 +153,85 @@ class HypothesisAgent:
         """
         return input(green("\nyou: "))
 
+    @property
+    def history_json(self) -> str:
+        """
+        The conversation history serialised as JSON; identical to dumps(self.conversation_history).
+        """
+        return self._history_json_cache.decode()
+
+    def _append(self, message: dict):
+        """
+        Appends a message to the conversation history and updates the serialised views with just the new message.
+
+        Args:
+            message: The message to append, with a role and content.
+        """
+        if len(self.conversation_history) == self.conversation_history.maxlen:
+            # should be prevented by _compact_history; drop the oldest unpinned message rather than the system one
+            del self.conversation_history[2 if self._summary else 1]
+            self._rebuild_views()
+        self.conversation_history.append(message)
+        del self._history_json_cache[-1]  # the closing bracket
+        if len(self.conversation_history) > 1:
+            self._history_json_cache += b','
+        self._history_json_cache += orjson.dumps(message) + b']'
+        self._conversation_lines.append(f'{message["role"]}: {message["content"]}')
+
+    def _rebuild_views(self):
+        """
+        Rebuilds the serialised views of the conversation history from scratch.
+        """
+        self._history_json_cache = bytearray(orjson.dumps(list(self.conversation_history)))
+        self._conversation_lines = [f'{m["role"]}: {m["content"]}' for m in self.conversation_history]
+
+    async def _compact_history(self):
+        """
+        Evicts the older half of the conversation and folds it into a one-sentence summary, which is pinned as a
+        system message after the main one.
+        """
+        pinned = 2 if self._summary else 1
+        recent = list(self.conversation_history)[pinned:]
+        evicted, kept = recent[:len(recent) // 2], recent[len(recent) // 2:]
+        conversation = '\n'.join(f'{m["role"]}: {m["content"]}' for m in evicted)
+        response = await client.chat.completions.create(
+            model=self.model,
+            messages=build_messages(
+                SUMMARY_SYSTEM_MESSAGE,
+                SUMMARY_PROMPT.format(summary=self._summary or 'not available', conversation=conversation)
+            ),
+            user=self.session_id
+        )
+        self._summary = response.choices[0].message.content
+        logger.info(f"Summarised {len(evicted)} older messages of the conversation.")
+        self.conversation_history = deque(
+            [self.conversation_history[0],
+             {"role": "system", "content": f"Summary of the earlier conversation: {self._summary}"},
+             *kept],
+            maxlen=config.MAX_HISTORY
+        )
+        self._rebuild_views()
+
+    def _reset_history(self):
+        """
+        Resets the conversation history to just the system message.
+        """
+        self.conversation_history = deque(maxlen=config.MAX_HISTORY)
+        self._summary = None
+        self._history_json_cache = bytearray(b'[]')
+        self._conversation_lines = []
+        self._append(RESPONSE_SYSTEM_MESSAGE)
+
     def start(self):
         """
         Starts the user interaction in the command line.
         """
+        asyncio.run(self._start())
+
+    async def _start(self):
+        """
+        Runs the user interaction loop. This is hidden so that the whole session shares a single event loop.
+        """
         self.ha_says(
               f"Hello! My name is {blue('ha')}, and I am an experimental agent specialising in biomedical research. "
               f"I have access to KEGG and GAF data. You can ask me anything related to these topics. "
@@ -74,37 +250,16 @@ class HypothesisAgent:
                 self.ha_says("Bye!")
                 break
             elif user_input.lower() == 'clear':
-                self.conversation_history = []
+                self._reset_history()
                 self.ha_says("Conversation history cleared.")
                 continue
 
-            agent_reply = self.handle_user_input(user_input)
-            self.ha_says(agent_reply)
+            # replies are printed (streamed) by the handlers themselves
+            await self.handle_user_input(user_input)
 
-    def set_objective(self, conversation: list) -> str:
-        """
-        Set the objective for the conversation.
-
-        Args:
-            conversation: The conversation history.
+        await close_clients()
 
-        Returns:
-            The objective for the conversation.
-        """
-        prompt = (f"We are about to give a task to a biomedical hypothesis agent with access to KEGG and GAF data."
-                  f"Given the following conversation history, set the objective for the agent. "
-                  f"Be very brief and specific."
-                  f"Conversation History:\n{json.dumps(conversation)}\n")
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that sets objectives based on conversation history."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.choices[0].message.content
-
-    def handle_user_input(self, user_input: str):
+    async def handle_user_input(self, user_input: str):
         """
         Choose an action based on the conversation history. Possible actions are:
         1. Answer directly -- choose this if the question is not related to KEGG or GAF data.
@@ -117,45 +272,42 @@ class HypothesisAgent:
         Returns:
             The action chosen by the chatbot.
         """
-        prompt = (f"Given the following conversation history, choose the best action to take next."
-                  f"Conversation History:\n{json.dumps(self.conversation_history)}\n"
-                  f"And user input: {user_input}\n\n"
-                  f"Choose the best action to take next, focus on the later part of the conversation:\n"
-                  f"1. answer -- choose this if the question is NOT in the biomedical domain, related to genes, "
-                  f"KEGG or GAF data.\n"
-                  f"2. ask -- ask a follow-up question; choose if you think you need more information; max 3 follow-ups.\n"
-                  f"3. agent -- choose if the question is related to biomedical domain, KEGG or GAF data and analysis.\n"
-                  f"Respond with the following JSON: {{'action': '<action here: answer/ask/agent>'}}")
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that makes decisions and responds with JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0,
-            response_format={"type": "json_object"}
-        )
-        try:
-            jsn = json.loads(response.choices[0].message.content)
-            action = jsn["action"]
+        # obvious turns are routed on their keywords, without asking the model
+        action = self.router.route(user_input) if self.router else None
+        if action:
+            logger.info(f"Action routed on keywords: {action}")
+            return await self._actions[action](user_input)
+
+        prompt = ACTION_PROMPT.format(history=self.history_json, user_input=user_input)
+        messages = build_messages(ACTION_SYSTEM_MESSAGE, prompt)
+        # the choice is deterministic (temperature 0), so an identical request can reuse the previous choice
+        cache_key = exact_cache.key(self.model, messages, temperature=0.0)
+        for _ in range(MAX_RETRY):
+            content = exact_cache.get(cache_key)
+            if content is None:
+                response = await client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.0,
+                    response_format=ACTION_FORMAT,
+                    user=self.session_id
+                )
+                content = response.choices[0].message.content
+            try:
+                action = loads(content)["action"]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                logger.error(f"Failed to get an action from {self.model}. Response: {content}")
+                continue
             logger.info(f"Action chosen: {action}")
-            match action:
-                case "answer":
-                    return self.get_response(user_input)
-                case "ask":
-                    return self.ask_follow_up(user_input)
-                case "agent":
-                    return self.ask_ha(user_input)
-                case _:
-                    return self.handle_user_input(user_input)
-        except json.JSONDecodeError:
-            logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
-            return self.handle_user_input(user_input)
-        except KeyError:
-            logger.error(f"KeyError: 'action' not found in response. Response: {response}")
-            return self.handle_user_input(user_input)
-
-    def get_response(self, user_input):
+            handler = self._actions.get(action) if isinstance(action, str) else None
+            if handler:
+                exact_cache.put(cache_key, content)
+                return await handler(user_input)
+
+        logger.error(f"No valid action chosen after {MAX_RETRY} attempts. Answering directly.")
+        return await self.get_response(user_input)
+
+    async def get_response(self, user_input):
         """
         Get the response from the OpenAI API based on user input.
 
@@ -165,21 +317,44 @@ class HypothesisAgent:
         Returns:
             The response from the chatbot.
         """
-        # Add the user input to the conversation history
-        self.conversation_history.append({"role": "user", "content": user_input})
+        # Make room for the user input and the reply, then add the user input to the conversation history
+        if len(self.conversation_history) + 2 > self.conversation_history.maxlen:
+            try:
+                await self._compact_history()
+            except Exception as e:
+                logger.error(f"Failed to summarise the conversation history: {e}")
+        # only an opening question is answered from the cache: its reply depends on the system prompt and the question
+        # alone, so it can be shared across sessions, while later replies depend on the whole conversation
+        opening = len(self.conversation_history) == 1
+        scope = SemanticCache.scope_for('get_response', self.model, self.conversation_history[0]["content"])
+        self._append({"role": "user", "content": user_input})
 
         try:
-            response = client.chat.completions.create(model=self.model, messages=self.conversation_history)
-            bot_reply = response.choices[0].message.content
+            cached = await self._cache_lookup(self.cache, user_input, scope) if opening else None
+            if cached is not None:
+                self._append({"role": "assistant", "content": cached})
+                self.ha_says(cached)
+                return cached
+
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=list(self.conversation_history),
+                user=self.session_id,
+                stream=True
+            )
+            bot_reply = await self.ha_streams(response)
 
             # Add the bot reply to the conversation history
-            self.conversation_history.append({"role": "assistant", "content": bot_reply})
+            self._append({"role": "assistant", "content": bot_reply})
+            if opening:
+                await self._cache_store(self.cache, user_input, bot_reply, scope)
 
             return bot_reply
         except Exception as e:
+            self.ha_says(f"Error: {e}")
             return f"Error: {e}"
 
-    def ask_follow_up(self, user_input: str):
+    async def ask_follow_up(self, user_input: str):
         """
         Ask a follow-up question based on the user input.
 
@@ -189,17 +364,45 @@ class HypothesisAgent:
         Returns:
             The follow-up question generated by the chatbot.
         """
-        prompt = f"Given the user input: {user_input}, generate a follow-up question to get more information."
-        response = client.chat.completions.create(
+        # the follow-up depends on the user input alone, not on the conversation, so it is shared across sessions
+        scope = SemanticCache.scope_for('ask_follow_up', self.model, FOLLOW_UP_SYSTEM_MESSAGE["content"])
+        cached = await self._cache_lookup(self.cache, user_input, scope)
+        if cached is not None:
+            self.ha_says(cached)
+            return cached
+
+        prompt = FOLLOW_UP_PROMPT.format(user_input=user_input)
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates follow-up questions."},
-                {"role": "user", "content": prompt}
-            ]
+            messages=build_messages(FOLLOW_UP_SYSTEM_MESSAGE, prompt),
+            user=self.session_id,
+            stream=True
         )
-        return response.choices[0].message.content
+        follow_up = await self.ha_streams(response)
+        await self._cache_store(self.cache, user_input, follow_up, scope)
+        return follow_up
+
+    @staticmethod
+    async def _cache_lookup(cache: Optional[SemanticCache], text: str, scope: str, **kwargs):
+        # the cache is an optimisation; an embeddings error (rate limit, network) counts as a miss
+        if not cache:
+            return None
+        try:
+            return await cache.lookup(text, scope, **kwargs)
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
 
-    def ask_ha(self, user_input: str):
+    @staticmethod
+    async def _cache_store(cache: Optional[SemanticCache], text: str, response: str, scope: str):
+        if not cache:
+            return
+        try:
+            await cache.store(text, response, scope)
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
+
+    async def ask_ha(self, user_input: str):
         """
         Pass the user input to the HA for analysis.
 
@@ -210,26 +413,53 @@ class HypothesisAgent:
             The response from the HA.
         """
         self.ha_says("Hey, I think I need to do a bit of analysis on this. It will take a while...\n")
-        conversation = [f'{i["role"]}: {i["content"]}'
-                        for i in self.conversation_history + [{"role": "user", "content": user_input}]]
-        objective = self.set_objective(conversation)
-        plan = self.planner.run(
-            conversation=conversation,
-            objective=objective,
-        )
+        conversation = self._conversation_lines + [f'user: {user_input}']
+        conversation_json = dumps(conversation)
+        # the planner sets the objective itself while planning
+        response = await self.planner.run(conversation=conversation)
+        objective, plan = response["objective"], response["plan"]
         self.ha_says(f"I have a plan. Here's a peek:\n")
         print_pretty_tasks(plan)
-        self.ha_says("\n\nExecuting the plan...\n")
-        analysis = self.plan_executor.run(plan)
-        self.ha_says(f"Analysis complete.")
-        hypothesis = self.generate_hypothesis(
-            analysis=json.dumps(analysis),
-            conversation=json.dumps(conversation),
+        analysis = await self.get_analysis(objective, plan)
+        hypothesis = await self.generate_hypothesis(
+            analysis=dumps(analysis),
+            conversation=conversation_json,
             objective=objective
         )
         return hypothesis
 
-    def generate_hypothesis(self, analysis: str, conversation: str, objective: str) -> str:
+    async def get_analysis(self, objective: str, plan: list) -> list:
+        """
+        Execute the plan, reusing the analysis of an identical plan or of a near-duplicate objective from earlier
+        in the session. Both caches are kept in memory and hold the last ANALYSIS_CACHE_SIZE analyses.
+
+        Args:
+            objective: The objective of the plan.
+            plan: The plan to execute.
+
+        Returns:
+            The analysis results.
+        """
+        key = hashlib.blake2b(orjson.dumps(plan, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+        analysis = self._analysis_cache.get(key)
+        scope = SemanticCache.scope_for('analysis', self.model)
+        if analysis is None:
+            cached = await self._cache_lookup(self._similar_analyses, objective, scope,
+                                              threshold=config.SEMANTIC_CACHE_ANALYSIS_THRESHOLD)
+            analysis = loads(cached) if cached is not None else None
+        if analysis is not None:
+            self.ha_says("I have already done this analysis, reusing the results.")
+            self._analysis_cache.put(key, analysis)
+            return analysis
+
+        self.ha_says("\n\nExecuting the plan...\n")
+        analysis = await self.plan_executor.run(plan)
+        self.ha_says(f"Analysis complete.")
+        self._analysis_cache.put(key, analysis)
+        await self._cache_store(self._similar_analyses, objective, dumps(analysis), scope)
+        return analysis
+
+    async def generate_hypothesis(self, analysis: str, conversation: str, objective: str) -> str:
         """
         Generate a hypothesis based on the analysis.
 
@@ -241,17 +471,11 @@ class HypothesisAgent:
         Returns:
             The hypothesis generated by the chatbot.
         """
-        prompt = (f"Given the following analysis results: {analysis}\n"
-                  f"And the original conversation and analysis objective:\n"
-                  f"Conversation: {conversation}\n"
-                  f"Objective: {objective}\n"
-                  f"Generate an appropriate hypothesis. Include any relevant information from the analysis, "
-                  f"especially names of genes, any counts, values and other useful data.")
-        response = client.chat.completions.create(
+        prompt = HYPOTHESIS_PROMPT.format(conversation=conversation, objective=objective, analysis=analysis)
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates hypotheses based on analysis results."},
-                {"role": "user", "content": prompt}
-            ]
+            messages=build_messages(HYPOTHESIS_SYSTEM_MESSAGE, prompt),
+            user=self.session_id,
+            stream=True
         )
-        return response.choices[0].message.content
\ No newline at end of file
+        return await self.ha_streams(response)
\ No newline at end of file
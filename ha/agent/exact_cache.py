@@ -0,0 +1,121 @@
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import orjson
+
+from ha import config
+
+
+class ExactCache:
+    """
+    An LRU cache of completion contents keyed by a hash of the exact request. Only meant for deterministic
+    calls (temperature 0), where an identical request is expected to produce the same response.
+
+    Entries are kept in memory and, if a path is given, also persisted in SQLite so that they survive restarts;
+    entries found on disk are promoted to memory on their first use.
+    """
+
+    def __init__(self, maxsize: int = 4096, path: Optional[str] = None, ttl: int = config.EXACT_CACHE_TTL):
+        """
+        Initializes the exact-match cache.
+
+        Args:
+            maxsize: The maximum number of responses kept in memory; the least recently used ones are evicted first.
+            path: The path to the SQLite database of the disk tier; None keeps the cache in memory only.
+            ttl: The number of seconds a response stays valid on disk.
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        # the database is opened on first use; the shared cache is created whenever this module is imported
+        self._db: Optional[sqlite3.Connection] = None
+
+    @staticmethod
+    def key(model: str, messages: list, **params) -> str:
+        """
+        Builds the cache key of a completion request.
+
+        Args:
+            model: The model of the request.
+            messages: The messages of the request.
+            params: Any other request parameters that affect the response, e.g. temperature.
+
+        Returns:
+            The cache key.
+        """
+        payload = orjson.dumps((model, messages, params), option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    @property
+    def db(self) -> Optional[sqlite3.Connection]:
+        """
+        The connection to the disk tier, or None if the cache is in memory only.
+        """
+        if self._db is None and self.path:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # several processes (e.g. pytest-xdist workers) may share the file: readers do not block the writer in
+            # WAL mode, and a writer waits for the lock instead of failing with "database is locked"
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            if self.path != ':memory:':
+                self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS exact_cache (key TEXT PRIMARY KEY, value TEXT, ts INTEGER)")
+            self._db.commit()
+        return self._db
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Looks up a cached response.
+
+        Args:
+            key: The cache key, see ExactCache.key.
+
+        Returns:
+            The cached response or None on a miss.
+        """
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        row = self.db.execute("SELECT value FROM exact_cache WHERE key = ? AND ts >= ?",
+                              (key, int(time.time()) - self.ttl)).fetchone() if self.db else None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, row[0])
+        return row[0]
+
+    def put(self, key: str, value: Any):
+        """
+        Stores a response. Only string responses are persisted on disk.
+
+        Args:
+            key: The cache key, see ExactCache.key.
+            value: The response to cache.
+        """
+        self._remember(key, value)
+        if self.db and isinstance(value, str):
+            self.db.execute("INSERT OR REPLACE INTO exact_cache (key, value, ts) VALUES (?, ?, ?)",
+                            (key, value, int(time.time())))
+            self.db.commit()
+
+    def _remember(self, key: str, value: Any):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# shared by all agents within the process, and across runs through the disk tier
+exact_cache = ExactCache(path=config.EXACT_CACHE_PATH or None)
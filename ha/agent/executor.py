@@ -1,18 +1,91 @@
+import asyncio
 import logging
-import json
-from typing import Union, Dict, List, Tuple, Any
+import time
+from typing import Union, Dict, List, Tuple, Any, Optional
+
+import orjson
 
 from ha.utils import generative_execution
-from ha.models import openai_client as client
-from ha.utils import clean_markdown_response
+from ha.agent.exact_cache import exact_cache
+from ha.models import async_openai_client as client
+from ha.utils import ActionLog, build_messages, dumps, json_schema_format, loads
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Prompts; the system messages are shared objects so that every request starts with the same bytes
+REFLECT_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates judgements using a JSON template."
+               "Your response should follow this format:\n"
+               "{'acceptance': true/false, 'reflection': '<reflection here>'}"
+               "You only respond with JSON.\n"
+               "You will be given a query with its explanation and results, generated "
+               "based on some initial instructions. "
+               "You should reflect and decide whether:\n"
+               "1. The query is appropriate to address the instructions\n"
+               "2. The results can be used to generate a satisfactory response. "
+               "Bear in mind sometimes no results are also acceptable.\n"
+               "3. When deciding if the results are appropriate bear in mind "
+               "the original goal data template if specified."
+}
+# the same judgement, but the accepted response is generated in the same call
+REFLECT_AND_RESPOND_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates judgements using a JSON template."
+               "Your response should follow this format:\n"
+               "{'acceptance': true/false, 'reflection': '<reflection here>', "
+               "'response': '<response here if accepted, otherwise null>'}"
+               "You only respond with JSON.\n"
+               "You will be given a query with its explanation and results, generated "
+               "based on some initial instructions. "
+               "You should reflect and decide whether:\n"
+               "1. The query is appropriate to address the instructions\n"
+               "2. The results can be used to generate a satisfactory response. "
+               "Bear in mind sometimes no results are also acceptable.\n"
+               "3. When deciding if the results are appropriate bear in mind "
+               "the original goal data template if specified.\n"
+               "If you accept the results, also generate the response to the instructions based on the query "
+               "results; if a goal data template is specified the response should follow it."
+}
+# structured outputs; the model can only respond with these shapes
+REFLECT_FORMAT = json_schema_format("reflection", {
+    "acceptance": {"type": "boolean"},
+    "reflection": {"type": "string"},
+})
+REFLECT_AND_RESPOND_FORMAT = json_schema_format("reflection", {
+    "acceptance": {"type": "boolean"},
+    "reflection": {"type": "string"},
+    "response": {"type": ["string", "null"]},
+})
+REFLECT_PROMPT = ("Initial instructions: <<{instructions}>>\n"
+                  "Goal data template:\n{goal_template}\n--\n"
+                  "Query: <<{query}>>\n"
+                  "Explanation: <<{explanation}>>\n--\n"
+                  "Results:\n{response}\n")
+
+RESPONSE_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates responses to instructions."
+               "If provided your response should follow a specified data format.\n"
+               "Given the instructions, the goal data template and a reflection on "
+               "the query response, generate a response based on the query results."
+}
+RESPONSE_PROMPT = ("Instructions: {instructions}\n"
+                   "Goal data template: {goal_template}\n"
+                   "Reflection on the query response: {reflection}\n"
+                   "Query results: {query_response}")
+
 
 class QueryExecutor:
     NAME = "Query Executor"
+    # executors are created per tool; subclasses declare their own attributes so that instances carry no __dict__
+    __slots__ = ("model", "attempts", "default_attempts", "action_log", "_schema_cache", "_schema_dirty", "_schema_ts")
+    # when True the accepted results are turned into a response by a separate generate_response call
+    COMPAT_TWO_STEP = False
+    # seconds the schema is reused before it is fetched again
+    SCHEMA_TTL = 600
+
     def __init__(self, model: str, attempts: int = 3):
         """
         Initializes the query executor.
@@ -24,9 +97,14 @@ class QueryExecutor:
         self.model = model
         self.attempts = attempts
         self.default_attempts = attempts
-        self.action_log = []
-
-    def run(self, instructions: str, goal_template: str = 'flexible', reflection: str = '') -> Any:
+        self.action_log = ActionLog()
+        # the schema is fetched on first use and then reused for SCHEMA_TTL seconds; set _schema_dirty to fetch it
+        # again sooner
+        self._schema_cache: Optional[str] = None
+        self._schema_dirty = False
+        self._schema_ts = 0.0
+
+    async def run(self, instructions: str, goal_template: str = 'flexible', reflection: str = '') -> Any:
         """
         Runs the query executor. This is the main method that should be called to run the query executor.
 
@@ -38,12 +116,12 @@ class QueryExecutor:
         Returns:
             The result of the query
         """
-        self.attempts = self.default_attempts
-        return self._run(instructions, goal_template, reflection)
+        return await self._run(instructions, goal_template, reflection)
 
-    def _run(self, instructions: str, goal_template: str = 'flexible', reflection: str = '') -> Any:
+    async def _run(self, instructions: str, goal_template: str = 'flexible', reflection: str = '') -> Any:
         """
-        Runs the query executor. This is hidden in order to keep the attempts counter intact.
+        Runs the query executor, retrying until the reflection accepts the result or the attempts run out.
+        The attempts are counted locally so that concurrent runs on the same executor do not interfere.
 
         Args:
             instructions: The user's instruction/inquiry.
@@ -53,32 +131,34 @@ class QueryExecutor:
         Returns:
             The result of the query
         """
-        query, explanation = self.generate_query(instructions, goal_template, reflection, self.get_schema())
-        query_response = self.execute_query(query)
-        query_response_str = self.cast_query(query_response)
-        reflection_success, reflection = self.reflect(
-            instructions=instructions,
-            goal_template=goal_template,
-            query=query,
-            explanation=explanation,
-            response=query_response_str)
-        self.attempts -= 1
-        self.log(instructions, goal_template, query_response_str, reflection_success, reflection)
-        if reflection_success:
-            logger.info(f"{self.NAME} thinks their answer is correct.")
-            return self.generate_response(instructions, goal_template, reflection, query_response_str)
-        elif self.attempts:
-            logger.info(f"{self.NAME} thinks their answer is incorrect because:{reflection}. Retrying... Attempts left: {self.attempts}")
-            return self._run(instructions, goal_template, reflection)
-        else:
-            logger.error(f"{self.NAME} failed after {self.default_attempts} attempts. Passing the log.")
-            return ({
-                "error": f"Reflection failed after {self.default_attempts} attempts.",
-                "log": self.action_log
-            })
+        for attempt in range(1, self.attempts + 1):
+            query, explanation = await self.generate_query(instructions, goal_template, reflection, self.schema)
+            # queries are blocking (database drivers, pandas); run them in a thread so other steps can proceed
+            query_response = await asyncio.to_thread(self.execute_query, query)
+            query_response_str = self.cast_query(query_response)
+            reflection_success, reflection, response = await self.reflect(
+                instructions=instructions,
+                goal_template=goal_template,
+                query=query,
+                explanation=explanation,
+                response=query_response_str)
+            self.log(instructions, goal_template, query_response_str, reflection_success, reflection, attempt)
+            if reflection_success:
+                logger.info(f"{self.NAME} thinks their answer is correct.")
+                if response is not None:
+                    return response
+                return await self.generate_response(instructions, goal_template, reflection, query_response_str)
+            if attempt < self.attempts and logger.isEnabledFor(logging.INFO):
+                logger.info(f"{self.NAME} thinks their answer is incorrect because:{reflection}. Retrying... Attempts left: {self.attempts - attempt}")
+
+        logger.error(f"{self.NAME} failed after {self.default_attempts} attempts. Passing the log.")
+        return ({
+            "error": f"Reflection failed after {self.default_attempts} attempts.",
+            "log": list(self.action_log)
+        })
 
     @generative_execution
-    def generate_query(self, instructions: str, goal_template: str, reflection: str, schema: str) -> tuple:
+    async def generate_query(self, instructions: str, goal_template: str, reflection: str, schema: str) -> tuple:
         """
         Generates a query based on the instructions, goal template, reflection, and schema.
 
@@ -106,12 +186,13 @@ class QueryExecutor:
         pass
 
     @generative_execution
-    def reflect(self, instructions: str, goal_template: str, query: str, response: str,
-                explanation: str) -> Tuple[bool, str]:
+    async def reflect(self, instructions: str, goal_template: str, query: str, response: str,
+                explanation: str) -> Tuple[bool, str, Optional[str]]:
         """
         Reflects on the query response and determines if the response is correct or satisfactory. If the response is
         correct, the method should return True and a reflection message. If the response is incorrect, the method should
-        return False and a reflection message.
+        return False and a reflection message. Unless COMPAT_TWO_STEP is set, an accepted response also comes with the
+        final response generated from the results, which saves the generate_response call.
 
         Args:
             instructions: The instructions for the query.
@@ -121,45 +202,46 @@ class QueryExecutor:
             explanation: The explanation for the query.
 
         Returns:
-            A tuple containing a boolean indicating if the response is correct and a reflection message.
+            A tuple containing a boolean indicating if the response is correct, a reflection message and the final
+            response (None if not accepted or not generated).
         """
         logger.info(f"Reflecting on the query response.")
-        prompt = (f"Consider the following query: <<{query}>>\n"
-                  f"And its explanation: <<{explanation}>>\n--\n"
-                  f"And its results:\n{response}\n--\n"
-                  f"They were generated based on the initial instructions: <<{instructions}>>\n"
-                  f"You should reflect and decide whether:\n"
-                  f"1. The query is appropriate to address the instructions\n"
-                  f"2. The results can be used to generate a satisfactory response. "
-                  f"Bear in mind sometimes no results are also acceptable.\n"
-                  f"3. When deciding if the results are appropriate bear in mind "
-                  f"the original goal data template if specified. See here:\n{goal_template}")
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates judgements using a JSON template."
-                                              "Your response should follow this format:\n"
-                                              "{'acceptance': true/false, 'reflection': '<reflection here>'}"
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
-            response_format={"type": "json_object"}
-        )
+        prompt = REFLECT_PROMPT.format(instructions=instructions, goal_template=goal_template, query=query,
+                                       explanation=explanation, response=response)
+        if self.COMPAT_TWO_STEP:
+            system_message, response_format = REFLECT_SYSTEM_MESSAGE, REFLECT_FORMAT
+        else:
+            system_message, response_format = REFLECT_AND_RESPOND_SYSTEM_MESSAGE, REFLECT_AND_RESPOND_FORMAT
+        messages = build_messages(system_message, prompt)
+        # the same query with the same results gets the same judgement
+        cache_key = exact_cache.key(self.model, messages, temperature=0.0)
+        content = exact_cache.get(cache_key)
+        if content is None:
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.0,
+                response_format=response_format
+            )
+            content = response.choices[0].message.content
 
         # Extract the response from the assistant
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
-            logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
-            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
+            jsn = loads(content)
+        except (orjson.JSONDecodeError, TypeError):
+            logger.error(f"Failed to decode JSON response from {self.model}. Response: {content}")
+            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {content}")
         acceptance = jsn["acceptance"]
         reflection = jsn["reflection"]
+        exact_cache.put(cache_key, content)
+        final_response = jsn.get("response") if acceptance and not self.COMPAT_TWO_STEP else None
+        if final_response is not None and not isinstance(final_response, str):
+            # the model tends to inline a JSON goal template as an object
+            final_response = dumps(final_response)
 
-        return acceptance, reflection
+        return acceptance, reflection, final_response
 
-    def generate_response(self, instructions: str, goal_template: str, reflection: str, query_response: str) -> str:
+    async def generate_response(self, instructions: str, goal_template: str, reflection: str, query_response: str) -> str:
         """
         Generate a response based on the instructions, goal template, reflection, and query response.
 
@@ -172,23 +254,26 @@ class QueryExecutor:
         Returns:
             The response to the query.
         """
-        prompt = (f"Given the following instructions: {instructions}\n"
-                  f"Reflecting on the query response: {reflection}\n"
-                  f"And the goal data template: {goal_template}\n"
-                  f"Generate a response based on the query results: {query_response}")
-        response = client.chat.completions.create(
+        prompt = RESPONSE_PROMPT.format(instructions=instructions, goal_template=goal_template, reflection=reflection,
+                                        query_response=query_response)
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates responses to instructions."
-                                              "If provided your response should follow a specified data format"},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ]
+            messages=build_messages(RESPONSE_SYSTEM_MESSAGE, prompt),
         )
 
         return response.choices[0].message.content
 
+    @property
+    def schema(self) -> str:
+        """
+        The schema of the database that is being queried, cached for SCHEMA_TTL seconds after a call to get_schema.
+        """
+        if self._schema_cache is None or self._schema_dirty or time.monotonic() - self._schema_ts >= self.SCHEMA_TTL:
+            self._schema_cache = self.get_schema()
+            self._schema_dirty = False
+            self._schema_ts = time.monotonic()
+        return self._schema_cache
+
     def get_schema(self) -> str:
         """
         Get the schema of the database that is being queried.
@@ -211,7 +296,7 @@ class QueryExecutor:
         return query
 
     def log(self, instructions: str, goal_template: str, generated_response: str,
-            reflection_success: bool, reflection: str):
+            reflection_success: bool, reflection: str, attempt: int):
         """
         Adds the current query and parameters to the action log.
 
@@ -221,6 +306,7 @@ class QueryExecutor:
             generated_response: The response generated by the query.
             reflection_success: Whether the reflection was successful.
             reflection: The reflection on the query response.
+            attempt: The attempt number, starting at 1.
         """
         self.action_log.append(
             {
@@ -229,6 +315,6 @@ class QueryExecutor:
                 "response": generated_response,
                 "reflection_success": reflection_success,
                 "reflection": reflection,
-                "attempt": self.default_attempts - self.attempts,
+                "attempt": attempt,
             }
         )
\ No newline at end of file
@@ -1,19 +1,96 @@
-import json
 import logging
-from typing import List
+from typing import Any, Dict, List
+
+import orjson
 
 from ha import config
-from ha.models import openai_client as client
-from ha.utils import clean_markdown_response, generative_execution
+from ha.agent.exact_cache import exact_cache
+from ha.models import async_openai_client as client
+from ha.utils import (ActionLog, build_messages, clean_markdown_response, dumps, generative_execution,
+                      json_schema_format, loads)
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# static prompt parts; serialised once so that every plan request starts with byte-identical text
+TOOL_DESCRIPTIONS_JSON = dumps(config.TOOL_DESCRIPTIONS)
+PLAN_TEMPLATE = ('{"objective": "<high-level objective here>", '
+                 '"plan": [{"objective": "<lower level objective here>", "tool": "<best tool for the job here>", '
+                 '"depends_on": [<0-based indices of earlier steps whose results this step needs>]}]}')
+
+PLAN_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates plans using JSON template."
+               "The response should be a list. Each item in the list look like this: \n"
+               "{'objective': '<lower level objective here>', "
+               "'tool': '<best tool for the job here>'}."
+               "You only respond with JSON.\n"
+               "First identify the high-level objective of the conversation for a "
+               "biomedical hypothesis agent with access to KEGG and GAF data; be very "
+               "brief and specific. Then generate a plan that satisfies it.\n"
+               "The plan should have at least one step and each step should have an "
+               "objective and a designated tool. "
+               "Make sure that the plan has steps that identify the corresponding "
+               "entities within each dataset. "
+               "For example, find the exact name of the colon cancer pathway in the "
+               "KEGG database.\n"
+               "List the steps each step depends on; independent steps (empty "
+               "depends_on) are executed in parallel.\n"
+               "Here's a list of the tools that can be used for the plan: \n"
+               f"{TOOL_DESCRIPTIONS_JSON}\n\n"
+               "Here's a template that needs to be used for the plan: \n"
+               f"{PLAN_TEMPLATE}"
+}
+PLAN_PROMPT = ("Given the following conversation:\n{conversation}\n"
+               "High-level goal (if available): {objective}\n"
+               "First identify the high-level objective; then generate a plan (a JSON list) that satisfies it.\n")
+
+REFLECT_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates judgements using a JSON template."
+               "Your response should follow this format:\n"
+               "{'acceptance': true/false, 'reflection': '<reflection here>'}"
+               "You only respond with JSON.\n"
+               "Given a conversation, a high-level goal and a plan, reflect on the "
+               "plan and decide whether it is appropriate and satisfactory. "
+               "Use the previous reflection if available."
+}
+POST_PROCESS_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system helps clean up JSON data. You only respond with JSON."
+}
+
+# structured outputs; the model can only respond with these shapes
+PLAN_FORMAT = json_schema_format("plan", {
+    "objective": {"type": "string"},
+    "plan": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "objective": {"type": "string"},
+                "tool": {"type": "string", "enum": list(config.TOOL_DESCRIPTIONS)},
+                "depends_on": {"type": "array", "items": {"type": "integer"}},
+            },
+            "required": ["objective", "tool", "depends_on"],
+            "additionalProperties": False,
+        },
+    },
+})
+REFLECT_FORMAT = json_schema_format("reflection", {
+    "acceptance": {"type": "boolean"},
+    "reflection": {"type": "string"},
+})
+
+REFLECT_PROMPT = ("Conversation: {conversation}\n"
+                  "High-level goal: {objective}\n"
+                  "Plan: {plan}\n"
+                  "Previous reflection (if available): {reflection}\n")
 
 class Planner:
 
     NAME = "Planner"
+    __slots__ = ("model", "attempts", "default_attempts", "action_log")
 
     def __init__(self, model: str = config.OPENAI_AGENT_MODEL, attempts: int = 3):
         """
@@ -26,110 +103,92 @@ class Planner:
         self.model = model
         self.attempts = attempts
         self.default_attempts = attempts
-        self.action_log = []
+        self.action_log = ActionLog()
 
-    def run(self, conversation: List[str], objective: str, reflection: str = '') -> List[dict]:
+    async def run(self, conversation: List[str], objective: str = '', reflection: str = '') -> Dict[str, Any]:
         """
         Runs the planner. This is the main method that should be called to run the planner.
 
         Args:
             conversation: The conversation to plan.
-            objective: Objective based on the plan
+            objective: An optional high-level goal; the planner identifies the objective from the conversation.
             reflection: The user's reflection on the previous response
 
         Returns:
-            The plan for best proceeding with the conversation.
+            The objective identified by the planner and the plan for best proceeding with the conversation:
+            {"objective": str, "plan": list}.
         """
-        self.attempts = self.default_attempts
-        return self._run(conversation, objective, reflection)
+        return await self._run(conversation, objective, reflection)
 
-    def _run(self, conversation: List[str], objective: str, reflection: str = '') -> List[dict]:
+    async def _run(self, conversation: List[str], objective: str = '', reflection: str = '') -> Dict[str, Any]:
         """
-        Runs the planner. This is hidden in order to keep the attempts counter intact.
+        Runs the planner, retrying until the reflection accepts the plan or the attempts run out.
 
         Args:
             conversation: The conversation to plan.
-            objective: Objective based on the plan
+            objective: An optional high-level goal; the planner identifies the objective from the conversation.
             reflection: The user's reflection on the previous response
 
         Returns:
-            The plan for best proceeding with the conversation.
+            The objective identified by the planner and the plan: {"objective": str, "plan": list}.
         """
-        plan = self.generate_plan(
-            conversation=json.dumps(conversation),
-            objective=objective
-        )
-        acceptance, reflection = self.reflect(
-            plan=json.dumps(plan),
-            conversation=json.dumps(conversation),
-            objective=objective,
-            reflection=reflection
-        )
-        self.attempts -= 1
-        self.log(
-            plan=json.dumps(plan),
-            conversation=json.dumps(conversation),
-            objective=objective,
-            reflection_success=acceptance,
-            reflection=reflection
-        )
-        if acceptance:
-            return plan
-        elif self.attempts:
-            return self._run(conversation, objective, reflection)
-        else:
-            return []
+        conversation_str = dumps(conversation)
+        goal = objective
+        for _ in range(self.attempts):
+            response = await self.generate_plan(
+                conversation=conversation_str,
+                objective=goal
+            )
+            # a failed generation comes back as an error dict without a plan
+            objective = response.get("objective") or goal
+            plan = response.get("plan", response)
+            plan_str = dumps(plan)
+            acceptance, reflection = await self.reflect(
+                plan=plan_str,
+                conversation=conversation_str,
+                objective=objective,
+                reflection=reflection
+            )
+            self.log(
+                plan=plan_str,
+                conversation=conversation_str,
+                objective=objective,
+                reflection_success=acceptance,
+                reflection=reflection
+            )
+            if acceptance:
+                return {"objective": objective, "plan": plan}
+        return {"objective": objective, "plan": []}
 
     @generative_execution
-    def generate_plan(self, conversation: str, objective: str) -> List[dict]:
+    async def generate_plan(self, conversation: str, objective: str = '') -> Dict[str, Any]:
         """
-        Generates a plan for the conversation based on the objective.
+        Identifies the objective of the conversation and generates a plan for it in the same call.
 
         Args:
             conversation: The conversation to plan.
-            objective: Objective based on the plan
+            objective: An optional high-level goal.
 
         Returns:
-            The plan for best proceeding with the conversation.
+            The objective and the plan for best proceeding with the conversation: {"objective": str, "plan": list}.
         """
-        logger.info(f"Generating a plan for the conversation with the objective: {objective}")
-        prompt = (
-            f"Given the following conversation:\n{conversation}\n"
-            f"Generate a plan (a JSON list) that satisfies this high-level goal: {objective}\n"
-            f"The plan should have at least one step and each step should have an objective and a designated tool."
-            f"Make sure that the plan has steps that identify the corresponding entities within each dataset."
-            f"For example, find the exact name of the colon cancer pathway in the KEGG database."
-            f"Here's a list of the tools that can be used for the plan: \n{json.dumps(config.TOOL_DESCRIPTIONS)}\n\n"
-            f"Here's a template that needs to be used for the plan: \n"
-            f"{{ \"plan\": "
-            f"[{{\"objective\": \"<lower level objective here>\", \"tool\": \"<best tool for the job here>\"}}}}]"
-        )
+        logger.info(f"Generating a plan for the conversation.")
+        prompt = PLAN_PROMPT.format(conversation=conversation, objective=objective)
         # Send the text prompt to GPT-4
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates plans using JSON template."
-                                              "The response should be a list. Each item in the list look like this: \n"
-                                              "{'objective': '<lower level objective here>', "
-                                              "'tool': '<best tool for the job here>'}."
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
-            response_format={"type": "json_object"}
+            messages=build_messages(PLAN_SYSTEM_MESSAGE, prompt),
+            response_format=PLAN_FORMAT
         )
-        # Parse the plan
+        # Parse the plan; the structured output only fails to parse on a refusal or a truncated response
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-            if isinstance(jsn, dict):
-                return jsn['plan']
-        except json.JSONDecodeError:
+            jsn = loads(response.choices[0].message.content)
+            return {"objective": jsn["objective"], "plan": jsn["plan"]}
+        except (orjson.JSONDecodeError, KeyError, TypeError):
             logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
             raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
-        return jsn
 
-    def reflect(self, plan: str, conversation: str, objective: str, reflection: str) -> tuple:
+    async def reflect(self, plan: str, conversation: str, objective: str, reflection: str) -> tuple:
         """
         Reflects on the plan and generates a reflection.
 
@@ -143,37 +202,32 @@ class Planner:
             A tuple containing a boolean indicating if the plan is appropriate and a reflection message.
         """
         logger.info(f"Reflecting on the plan.")
-        prompt = (
-            f"Consider the following plan: {plan}\n"
-            f"Based on the conversation: {conversation}\n"
-            f"And the high-level goal: {objective}\n"
-            f"Reflect on the plan and decide whether it is appropriate and satisfactory.\n"
-            f"Use this reflection if available: {reflection}\n"
-        )
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates judgements using a JSON template."
-                                              "Your response should follow this format:\n"
-                                              "{'acceptance': true/false, 'reflection': '<reflection here>'}"
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
-            response_format={"type": "json_object"}
-        )
+        prompt = REFLECT_PROMPT.format(conversation=conversation, objective=objective, plan=plan, reflection=reflection)
+        messages = build_messages(REFLECT_SYSTEM_MESSAGE, prompt)
+        # a retry (previous reflection present) should get a fresh judgement rather than the cached one
+        cache_key = exact_cache.key(self.model, messages, temperature=0.0) if not reflection else None
+        content = exact_cache.get(cache_key) if cache_key else None
+        if content is None:
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.0,
+                response_format=REFLECT_FORMAT
+            )
+            content = response.choices[0].message.content
         # Extract the response from the assistant
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
-            logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
-            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
+            jsn = loads(content)
+        except (orjson.JSONDecodeError, TypeError):
+            logger.error(f"Failed to decode JSON response from {self.model}. Response: {content}")
+            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {content}")
         acceptance = jsn["acceptance"]
         reflection = jsn["reflection"]
+        if cache_key:
+            exact_cache.put(cache_key, content)
         return acceptance, reflection
 
-    def post_process(self, plan: dict):
+    async def post_process(self, plan: dict):
         """
         Post-processes the plan by adding a reflection key to each item in the plan.
 
@@ -192,22 +246,17 @@ class Planner:
             }}
         ] 
         """
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system helps clean up JSON data. You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
+            messages=build_messages(POST_PROCESS_SYSTEM_MESSAGE, prompt),
             # response_format={"type": "json_object"} # this is such a controversial feature
         )
         try:
             print('postprocessing ' + response.choices[0].message.content)
             if response.choices[0].message.content.lower() == "no":
                 return
-            return json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError as e:
+            return loads(clean_markdown_response(response.choices[0].message.content))
+        except orjson.JSONDecodeError as e:
             logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
             raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
 
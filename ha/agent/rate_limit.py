@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    A token bucket for the requests per minute and (estimated) tokens per minute of an API. Both buckets start full
+    and refill continuously, so bursts up to the per-minute budget go through at once and the rest is spread out.
+    """
+
+    def __init__(self, rpm: int, tpm: int = 0):
+        """
+        Initializes the rate limiter.
+
+        Args:
+            rpm: The requests allowed per minute; 0 for no limit.
+            tpm: The tokens allowed per minute; 0 for no limit.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int = 0):
+        """
+        Waits until a request of the given size fits in the budget and takes it out of the buckets. There is no await
+        between the check and the update, so concurrent callers on the event loop cannot take the same budget.
+
+        Args:
+            tokens: The estimated tokens of the request; capped at the per-minute budget so that a large request
+                can still go through.
+        """
+        tokens = min(tokens, self.tpm)
+        while True:
+            self._refill()
+            missing_requests = 1 - self._requests if self.rpm else 0
+            missing_tokens = tokens - self._tokens if self.tpm else 0
+            if missing_requests <= 0 and missing_tokens <= 0:
+                if self.rpm:
+                    self._requests -= 1
+                if self.tpm:
+                    self._tokens -= tokens
+                return
+            await asyncio.sleep(max(missing_requests * 60 / self.rpm if self.rpm else 0,
+                                    missing_tokens * 60 / self.tpm if self.tpm else 0))
@@ -0,0 +1,61 @@
+import re
+from typing import Iterable, Optional
+
+from ha import config
+
+
+def _pattern(words: Iterable[str], patterns: Iterable[str] = ()) -> re.Pattern:
+    """
+    Compiles keywords into a single case-insensitive pattern, so that a turn is scanned once for all of them.
+
+    Args:
+        words: Keywords to match as whole words.
+        patterns: Regular expressions to match as whole words.
+
+    Returns:
+        The compiled pattern.
+    """
+    # longest first, so that e.g. 'go terms' wins over 'go term'
+    words = sorted(map(re.escape, words), key=len, reverse=True)
+    alternatives = [*words, *patterns]
+    return re.compile(rf"\b(?:{'|'.join(alternatives)})\b", re.IGNORECASE)
+
+
+class KeywordRouter:
+    """
+    Routes the obvious user turns without a model call: turns that mention biomedical terms go to the agent and
+    short small talk is answered directly. Anything else is left to the model.
+    """
+
+    def __init__(self, terms: Iterable[str] = (*config.KEGG_TERMS, *config.GAF_TERMS),
+                 gene_patterns: Iterable[str] = config.GENE_SYMBOL_PATTERNS,
+                 answer_keywords: Iterable[str] = config.ANSWER_KEYWORDS,
+                 answer_max_tokens: int = config.ANSWER_MAX_TOKENS):
+        """
+        Initializes the keyword router.
+
+        Args:
+            terms: Biomedical terms, matched as whole words.
+            gene_patterns: Gene symbol families, regular expressions matched as whole words.
+            answer_keywords: Small talk keywords, matched as whole words.
+            answer_max_tokens: The maximum number of tokens of a turn that is answered on keywords alone.
+        """
+        self.biomedical = _pattern(terms, gene_patterns)
+        self.answer = _pattern(answer_keywords)
+        self.answer_max_tokens = answer_max_tokens
+
+    def route(self, user_input: str) -> Optional[str]:
+        """
+        Chooses an action for the user input if it is obvious from its keywords.
+
+        Args:
+            user_input: The user input.
+
+        Returns:
+            'agent' or 'answer', or None if the model should choose.
+        """
+        if self.biomedical.search(user_input):
+            return 'agent'
+        if len(user_input.split()) <= self.answer_max_tokens and self.answer.search(user_input):
+            return 'answer'
+        return None
@@ -5,23 +5,71 @@ import os
 NEO4J_URI = os.getenv('NEO4J_URI', 'bolt://localhost:7687')
 NEO4J_USER = os.getenv('NEO4J_USER', 'neo4j')
 NEO4J_PASSWORD = os.getenv('NEO4J_PASSWORD', 'supersafepassword')
+# the driver's connection pool, shared by every tool; concurrent plan steps each hold a connection while querying
+NEO4J_MAX_POOL_SIZE = int(os.getenv('NEO4J_MAX_POOL_SIZE', '50'))
+NEO4J_ACQUISITION_TIMEOUT = float(os.getenv('NEO4J_ACQUISITION_TIMEOUT', '30'))
+# seconds the results of a read-only KEGG query are reused; 0 disables the cache
+KEGG_CACHE_TTL = int(os.getenv('KEGG_CACHE_TTL', '300'))
 
 # Load OpenAI API key from environment variable
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_NEO4J_MODEL = os.getenv('OPENAI_NEO4J_MODEL', 'gpt-4o')
 OPENAI_PANDAS_MODEL = os.getenv('OPENAI_PANDAS_MODEL', 'gpt-4o')
 OPENAI_AGENT_MODEL = os.getenv('OPENAI_AGENT_MODEL', 'gpt-4o')
+OPENAI_EMBEDDING_MODEL = os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+# retries of rate limited and failed requests within the SDK, on top of the retry of generative_execution
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+# the account's rate limits; requests are held back client side rather than rejected with a 429. 0 for no limit
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', '500'))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', '0'))
 
 # File paths
 PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 GAF_FILE_PATH = os.getenv('GAF_FILE', os.path.join(PROJECT_PATH, 'data', 'gaf', 'goa_human.gaf'))
 
+# Bounds on what is kept in memory; older conversation turns are summarised, older log entries go to a file
+MAX_HISTORY = int(os.getenv('MAX_HISTORY', '32'))
+MAX_ACTION_LOG = int(os.getenv('MAX_ACTION_LOG', '20'))
+ACTION_LOG_PATH = os.getenv('ACTION_LOG_PATH', os.path.join(PROJECT_PATH, '.cache', 'action_log.log'))
+
+# Semantic cache for direct answers and follow-up questions
+SEMANTIC_CACHE = os.getenv('SEMANTIC_CACHE', '1') == '1'
+SEMANTIC_CACHE_PATH = os.getenv('SEMANTIC_CACHE_PATH', os.path.join(PROJECT_PATH, '.cache', 'semantic_cache.sqlite'))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+SEMANTIC_CACHE_TTL = int(os.getenv('SEMANTIC_CACHE_TTL', '3600'))
+# the newest entries kept on disk; older and expired ones are evicted as new ones are stored
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '10000'))
+# analyses are reused for near-duplicate objectives only, so the bar is higher than for direct answers
+SEMANTIC_CACHE_ANALYSIS_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_ANALYSIS_THRESHOLD', '0.95'))
+
+# Exact-match cache for deterministic (temperature 0) completions; set EXACT_CACHE_PATH to '' to keep it in memory
+EXACT_CACHE_PATH = os.getenv('EXACT_CACHE_PATH', os.path.join(PROJECT_PATH, '.cache', 'exact_cache.sqlite'))
+EXACT_CACHE_TTL = int(os.getenv('EXACT_CACHE_TTL', str(7 * 24 * 3600)))
+
+# Keyword router; obvious turns are routed locally instead of asking the model to choose an action
+KEYWORD_ROUTER = os.getenv('KEYWORD_ROUTER', '1') == '1'
+# only unambiguous terms force the agent; words such as "gene", "receptor" or "pathway" also occur in questions the
+# model should answer directly, e.g. "what is a receptor?", so they are left to the model
+KEGG_TERMS = ["kegg", "neo4j"]
+GAF_TERMS = ["gaf", "go term", "go terms", "gene ontology", "biological process", "molecular function",
+             "cellular component", "evidence code", "uniprot"]
+# gene symbol families as regular expressions matched as whole words, shaped like the symbols themselves so that
+# ordinary words are not mistaken for genes (e.g. jak[1-3] matches JAK2 but not "Jake" or "Jakarta")
+GENE_SYMBOL_PATTERNS = [r"insr", r"irs[1-4]", r"pik3c[abdg]", r"pik3c2[abg]", r"pik3c3", r"pik3r[1-6]", r"akt[1-3]?",
+                        r"mapk(?:[1-9]|1[0-5])", r"tp53", r"brca[12]", r"egfr", r"kras", r"tnf(?:-?alpha|a)?",
+                        r"jak[1-3]", r"stat3", r"il6(?:r|st)?", r"foxo[1346]", r"mtor"]
+# short turns with one of these and no biomedical term are answered directly
+ANSWER_KEYWORDS = ["hi", "hello", "hey", "thanks", "thank you", "thx", "cheers", "bye", "goodbye", "ok", "okay",
+                   "good morning", "good evening", "how are you"]
+# turns with more tokens than this are never answered on keywords alone
+ANSWER_MAX_TOKENS = 10
+
 TOOL_DESCRIPTIONS = {
     "kegg_query":       "KEGG is a database of disease pathways stored in a Neo4j instance."
                         "The tool allows the retrieval of information about the signaling chains"
                         "between genes in a disease pathway. Use to find relationships between genes and diseases.",
     "gaf_query":        "The GAF database instance contains GO terms and annotations for "
-                        "human genes. The tool allows queries using SQLite and the "
+                        "human genes. The tool allows queries using DuckDB SQL and the "
                         "standard GAF file headings.",
     "graph_analysis":   "The Graph Analysis gives you an informative network analysis about a gene symbol (node_name)"
                         "in the context of a disease pathway (pathway_title).\n"
@@ -0,0 +1,12 @@
+import logging
+
+
+def setup_logging(level: int = logging.INFO):
+    """
+    Configures logging for the command line application. Library modules only create their loggers; this should be
+    called once by the entry point.
+
+    Args:
+        level: The logging level of the root logger.
+    """
+    logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -1,7 +1,8 @@
 import logging
 
-import openai
 from ha import config
+from ha.agent.rate_limit import RateLimiter
+from ha.utils import LazyObject
 
 
 # Get the OpenAI logger
@@ -18,6 +19,51 @@ requests_logger.setLevel(logging.CRITICAL)  # or higher level like logging.FATAL
 urllib3_logger = logging.getLogger("urllib3")
 urllib3_logger.setLevel(logging.CRITICAL)
 
-# Set the OpenAI API key
-openai.api_key = config.OPENAI_API_KEY
-openai_client = openai.Client()
+
+_rate_limiter = RateLimiter(rpm=config.OPENAI_RPM, tpm=config.OPENAI_TPM)
+
+
+def _http_options() -> dict:
+    # One pooled HTTP/2 connection, shared by every agent and tool, so that TLS handshakes are paid once
+    # and concurrent requests are multiplexed instead of opening new connections
+    import httpx
+    return {
+        "http2": True,
+        "limits": httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30.0),
+        "timeout": httpx.Timeout(60.0, connect=5.0),
+    }
+
+
+async def _rate_limit(request):
+    # an httpx request hook, so that every call of the shared client waits for its turn; roughly four bytes a token.
+    # Streamed bodies (file uploads) are not read here and only count as a request
+    import httpx
+    try:
+        tokens = len(request.content) // 4
+    except httpx.RequestNotRead:
+        tokens = 0
+    await _rate_limiter.acquire(tokens)
+
+
+def _async_openai_client():
+    import httpx
+    import openai
+    options = _http_options()
+    if config.OPENAI_RPM or config.OPENAI_TPM:
+        options["event_hooks"] = {"request": [_rate_limit]}
+    # the SDK sets its own (10 minute) timeout on every request unless it is given one
+    return openai.AsyncOpenAI(api_key=config.OPENAI_API_KEY, max_retries=config.OPENAI_MAX_RETRIES,
+                              timeout=options["timeout"], http_client=httpx.AsyncClient(**options))
+
+
+# The client (and the openai package) is only loaded on first use; every agent and tool shares it
+async_openai_client = LazyObject(_async_openai_client)
+
+
+async def close_clients():
+    """
+    Closes the pooled connections of the shared client, if it was built. The async client can only be closed from
+    within the event loop that used it, so this is awaited at the end of the session rather than registered atexit.
+    """
+    if async_openai_client.built:
+        await async_openai_client.close()
@@ -1,6 +1,14 @@
-from neo4j import GraphDatabase
-
 import ha.config as config
+from ha.utils import LazyObject
+
+
+def _driver():
+    from neo4j import GraphDatabase
+    return GraphDatabase.driver(config.NEO4J_URI, auth=(config.NEO4J_USER, config.NEO4J_PASSWORD),
+                                max_connection_pool_size=config.NEO4J_MAX_POOL_SIZE,
+                                connection_acquisition_timeout=config.NEO4J_ACQUISITION_TIMEOUT,
+                                keep_alive=True)
 
 
-graphdb = GraphDatabase.driver(config.NEO4J_URI, auth=(config.NEO4J_USER, config.NEO4J_PASSWORD))
+# The driver (and the neo4j package) are only loaded on first use
+graphdb = LazyObject(_driver)
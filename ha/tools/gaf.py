@@ -1,18 +1,23 @@
-import json
+import asyncio
 import logging
+import os
 import warnings
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
 
-import pandas as pd
-import pandasql as ps
-import requests
+import orjson
 
 import ha.config as config
+from ha.agent.batch import batch_completions
 from ha.agent.executor import QueryExecutor
-from ha.models import openai_client as client
-from ha.utils import generative_execution, clean_markdown_response
+from ha.models import async_openai_client as client
+from ha.utils import LazyObject, build_messages, generative_execution, clean_markdown_response, loads
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 warnings.filterwarnings("ignore")
 
@@ -22,6 +27,34 @@ gaf_column_names = [
     'DB_Object_Name', 'Synonym', 'DB_Object_Type', 'Taxon', 'Date', 'Assigned_By', 'Annotation_Extension',
     'Gene_Product_Form_ID'
 ]
+# the columns that are kept in memory and offered to the generated queries; the wide free-text ones
+# (names, synonyms, extensions) are never used and are skipped when the file is parsed
+gaf_used_columns = [
+    'DB_Object_Symbol', 'Qualifier', 'GO_ID', 'DB:Reference', 'Evidence', 'Aspect', 'Taxon', 'Date', 'Assigned_By'
+]
+# rows parsed at a time when the GAF file is loaded
+GAF_CHUNK_SIZE = 200_000
+# low-cardinality columns; stored as categories instead of one Python string per row
+gaf_category_columns = ['Qualifier', 'Evidence', 'Aspect', 'Assigned_By']
+# part of the name of the Parquet cache of a GAF file; bump it whenever the parsed columns or their dtypes change so
+# that caches written by an older version are not read back
+GAF_CACHE_VERSION = 1
+
+# QuickGO term lookups; one pooled HTTP/2 client, and the names of terms already looked up
+QUICKGO_TERMS_URL = 'https://www.ebi.ac.uk/QuickGO/services/ontology/go/terms/{}'
+QUICKGO_BATCH_SIZE = 500
+
+
+def _quickgo_client():
+    import httpx
+    return httpx.Client(http2=True, timeout=10.0, headers={"Accept": "application/json"})
+
+
+_CLIENT = LazyObject(_quickgo_client)
+_GO_TERM_TEXTS: Dict[str, str] = {}
+
+# upper bound on the rows a query returns, whatever the generated query asks for
+MAX_RESULT_ROWS = 100
 
 # GO annotation evidence codes
 evidence_codes = {
@@ -51,21 +84,72 @@ evidence_codes = {
 
 gaf_tips = """
 - use the `DB_Object_Symbol` attribute to filter for gene symbols 
+- quote column names with special characters in double quotes, e.g. "DB:Reference"
 """
 
+@lru_cache(maxsize=8)
+def query_system_message(schema: str, limit: int) -> dict:
+    """
+    Builds the system message for GAF query generation; cached so that repeated requests share the same message.
+
+    Args:
+        schema: The pandas schema.
+        limit: The number of rows to limit the output to.
+
+    Returns:
+        The system message.
+    """
+    return {
+        "role": "system",
+        "content": "You are a system that generates queries using JSON template."
+                   "{'query': '<query here>', 'explanation': '<explanation here>'}."
+                   "You only respond with JSON.\n"
+                   f"Given the following pandas schema:\n{schema}\n"
+                   "The table name is 'gaf'.\n"
+                   f"Use these tips: {gaf_tips}\n"
+                   "Unless otherwise instructed already, limit the output to "
+                   f"{limit} rows."
+    }
+
+
 class Gaf(QueryExecutor):
 
     NAME = "GAF Query Executor"
+    __slots__ = ("gaf_file_path", "_data", "_by_symbol", "_ddb", "_load_lock")
 
     def __init__(self, gaf_file_path: str = config.GAF_FILE_PATH, model: str =config.OPENAI_PANDAS_MODEL,
                  attempts: int = 3):
         super().__init__(model, attempts)
-        self.data = self.load_data(gaf_file_path)
+        # the data is loaded on first use; the tool is created whenever the tools are imported
+        self.gaf_file_path = gaf_file_path
+        self._data = None
+        self._by_symbol = None
+        self._ddb = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def data(self) -> 'pd.DataFrame':
+        """
+        The GAF data, loaded on first access.
+        """
+        if self._data is None:
+            with self._load_lock:
+                if self._data is None:
+                    import duckdb
+                    data = self.load_data(self.gaf_file_path)
+                    # gene symbol -> row positions, so that filtering by gene is a lookup rather than a scan
+                    self._by_symbol = data.groupby('DB_Object_Symbol', sort=False).indices
+                    # DuckDB scans the DataFrame in place, so queries do not copy the data into a database first;
+                    # the queries are generated, so they may not read or write files or URLs
+                    self._ddb = duckdb.connect(config={'enable_external_access': False})
+                    self._data = data
+        return self._data
 
     @staticmethod
-    def load_data(file_path: str) -> pd.DataFrame:
+    def load_data(file_path: str) -> 'pd.DataFrame':
         """
-        Load the data from the GAF file.
+        Load the data from the GAF file. The parsed data is cached in a Parquet file next to the GAF file and
+        reused for as long as it is newer than the GAF file and was written by the same GAF_CACHE_VERSION.
 
         Args:
             file_path: The path to the GAF file.
@@ -73,7 +157,37 @@ class Gaf(QueryExecutor):
         Returns:
             The loaded data as a DataFrame
         """
-        return pd.read_csv(file_path, sep='\t', comment='!', header=None, names=gaf_column_names, low_memory=False)
+        import pandas as pd
+        from pandas.api.types import union_categoricals
+
+        cache = f'{file_path}.v{GAF_CACHE_VERSION}.parquet'
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(file_path):
+            return pd.read_parquet(cache, columns=gaf_used_columns)
+
+        # parsed in chunks so that the parser's buffers stay small; the other string columns are stored in Arrow
+        # buffers rather than as Python objects
+        chunks = list(pd.read_csv(file_path, sep='\t', comment='!', header=None, names=gaf_column_names,
+                                  usecols=gaf_used_columns, chunksize=GAF_CHUNK_SIZE,
+                                  dtype={column: 'category' for column in gaf_category_columns},
+                                  dtype_backend='pyarrow'))
+        # chunks see different categories; unify them so that the columns stay categorical once concatenated
+        for column in gaf_category_columns:
+            categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+        data = pd.concat(chunks, ignore_index=True)
+        del chunks
+        # written to a temporary file and moved into place, so that a concurrent or interrupted load never leaves a
+        # partial cache behind
+        partial = f'{cache}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            data.to_parquet(partial, compression='zstd')
+            os.replace(partial, cache)
+        except OSError as e:
+            logger.warning(f"Could not cache the GAF data at {cache}: {e}")
+            if os.path.exists(partial):
+                os.remove(partial)
+        return data
 
 
     def get_schema(self) -> str:
@@ -87,11 +201,11 @@ class Gaf(QueryExecutor):
         schema_str = self.data.dtypes.to_string()
         return schema_str
 
-    @generative_execution
-    def generate_query(self, instruction: str, goal_template:str, reflection: str, schema: str,
-                       limit: int = 10) -> tuple:
+    @generative_execution(speculative=2)
+    async def generate_query(self, instruction: str, goal_template:str, reflection: str, schema: str,
+                             limit: int = 10) -> tuple:
         """
-        Method that uses OpenAI to generate a SQLite query given a pandas schema and a request.
+        Method that uses OpenAI to generate a DuckDB SQL query given a pandas schema and a request.
 
         Args:
             instruction: The user's request.
@@ -103,33 +217,86 @@ class Gaf(QueryExecutor):
         Returns:
             The generated Neo4j query and explanation.
         """
+        response = await client.chat.completions.create(
+            **self.query_request(instruction, goal_template, reflection, schema, limit)
+        )
+        return self.parse_query(response.choices[0].message.content)
+
+    async def generate_queries(self, batch: List[dict], limit: int = 10, use_batch_api: bool = False,
+                               max_concurrency: int = 10) -> List[tuple]:
+        """
+        Generates the queries of many requests at once, either concurrently through the real-time API or through the
+        (cheaper, but slower) Batch API.
+
+        Args:
+            batch: The requests; dictionaries with an instruction and optionally a goal_template and a reflection.
+            limit: The number of rows to limit the output to.
+            use_batch_api: Whether to use the Batch API.
+            max_concurrency: The maximum number of concurrent real-time requests.
+
+        Returns:
+            The generated query and explanation of each request, in order; an error dictionary for a failed request.
+        """
+        schema = self.schema
+        items = [(item["instruction"], item.get("goal_template", "flexible"), item.get("reflection", ""))
+                     for item in batch]
+        if not use_batch_api:
+            semaphore = asyncio.Semaphore(max_concurrency)
+
+            async def bounded(instruction: str, goal_template: str, reflection: str) -> tuple:
+                async with semaphore:
+                    return await self.generate_query(instruction, goal_template, reflection, schema, limit)
+
+            return await asyncio.gather(*[bounded(*request) for request in items])
+
+        contents = await batch_completions([self.query_request(*request, schema, limit) for request in items])
+        results = []
+        for content in contents:
+            try:
+                results.append(self.parse_query(content))
+            except ValueError as e:
+                results.append({"error": str(e)})
+        return results
+
+    def query_request(self, instruction: str, goal_template: str, reflection: str, schema: str,
+                      limit: int = 10) -> dict:
+        """
+        Builds the chat completion request that generates a query.
+
+        Args:
+            instruction: The user's request.
+            goal_template: The goal template for the query.
+            reflection: The user's reflection on the previous response.
+            schema: The pandas schema.
+            limit: The number of rows to limit the output to.
+
+        Returns:
+            The keyword arguments of chat.completions.create.
+        """
         # TODO: this could be abstracted through prompt parametrisation but too much work for now
-        prompt = (f"Given the following pandas schema:\n{schema}\n"
-                  f"The table name is 'gaf'.\n"
+        prompt = (f"Take into account the goal data template if relevant: {goal_template}\n"
                   f"Use this reflection (if present): {reflection}\n"
-                  f"And these tips: {gaf_tips}\n"
-                  f"Take into account the goal data template if relevant: {goal_template}\n"
-                  f"Generate an SQLite query that satisfies this instruction: {instruction}"
-                  f"Unless otherwise instructed already, limit the output to {limit} rows.")
-
-        # Send the image and text prompt to GPT-4 with Vision
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates queries using JSON template."
-                                              "{'query': '<query here>', 'explanation': '<explanation here>'}."
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
-            response_format={"type": "json_object"}
-        )
+                  f"Generate a DuckDB SQL query that satisfies this instruction: {instruction}")
+        return {
+            "model": self.model,
+            "messages": build_messages(query_system_message(schema, limit), prompt),
+            "response_format": {"type": "json_object"},
+        }
+
+    @staticmethod
+    def parse_query(content: Optional[str]) -> tuple:
+        """
+        Extracts the query and its explanation from a response.
 
-        # Extract the response from the assistant
+        Args:
+            content: The content of the response.
+
+        Returns:
+            The query and the explanation.
+        """
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
+            jsn = loads(clean_markdown_response(content))
+        except (orjson.JSONDecodeError, TypeError):
             raise ValueError("Failed to decode JSON response from OpenAI.")
         query = jsn["query"]
         explanation = jsn["explanation"]
@@ -138,7 +305,7 @@ class Gaf(QueryExecutor):
 
     def execute_query(self, query: str) -> str:
         """
-        Execute the query on the GAF data using SQLite on pandas data.
+        Execute the query on the GAF data using DuckDB on pandas data.
 
         Args:
             query: The query to execute.
@@ -146,12 +313,24 @@ class Gaf(QueryExecutor):
         Returns:
             The result of the query.
         """
+        import duckdb
+
         try:
             logger.info(f"Executing query: {query}")
-            gaf = self.data
-            result = ps.sqldf(query, locals())
-            return result.to_string()
-        except ps.PandaSQLException as e:
+            data = self.data
+            # a cursor per query, since queries run concurrently in worker threads; registering the frame is free
+            cursor = self._ddb.cursor()
+            try:
+                cursor.register("gaf", data)
+                relation = cursor.sql(query)
+                if relation is None:
+                    return ''
+                # the limit is pushed into the query so that no more rows are materialised; CSV is the most compact
+                # text for the model to read
+                return relation.limit(MAX_RESULT_ROWS).df().to_csv(index=False)
+            finally:
+                cursor.close()
+        except duckdb.Error as e:
             logger.error(f"SQL execution error: {e}")
             return f"SQL execution error: {e}"
         except KeyError as e:
@@ -174,19 +353,24 @@ class Gaf(QueryExecutor):
         Returns:
             The filtered and simplified table.
         """
-        # filter the data by gene symbol and optionally by qualifier
-        q_df = self.data[self.data['DB_Object_Symbol'] == gene_symbol]
+        # filter the data by gene symbol and optionally by qualifier; only the needed columns are gathered
+        data = self.data
+        q_df = data.iloc[self._by_symbol.get(gene_symbol, [])][['DB_Object_Symbol', 'Qualifier', 'GO_ID', 'Evidence']]
         if qualifier:
             q_df = q_df[q_df['Qualifier'] == qualifier]
-        q_df['GO_annotation'] = q_df['GO_ID'].map(get_go_term_text)
-        q_df['Evidence'] = q_df['Evidence'].map(evidence_codes)
-        q_df['Gene'] = q_df['DB_Object_Symbol']
+        go_terms = get_go_term_texts(q_df['GO_ID'].unique())
+        q_df = q_df.assign(
+            Gene=q_df['DB_Object_Symbol'],
+            GO_annotation=q_df['GO_ID'].map(go_terms),
+            # Evidence is categorical; renaming the categories leaves the per-row codes untouched
+            Evidence=q_df['Evidence'].cat.rename_categories(evidence_codes)
+        )
         return q_df[['Gene', 'Qualifier', 'GO_annotation', 'Evidence']].to_string(index=False)
 
 
 def get_go_term_text(go_id: str) -> str:
     """
-    Get the text description of a GO term.
+    Get the text description of a GO term. Terms are looked up once and shared with get_go_term_texts.
 
     Args:
         go_id: The GO term ID.
@@ -194,7 +378,29 @@ def get_go_term_text(go_id: str) -> str:
     Returns:
         The text description of the GO term.
     """
+    if go_id in _GO_TERM_TEXTS:
+        return _GO_TERM_TEXTS[go_id]
     # make a request to get the text description of the GO term from QuickGO
-    r = requests.get(f'https://www.ebi.ac.uk/QuickGO/services/ontology/go/terms/{go_id}')
+    r = _CLIENT.get(QUICKGO_TERMS_URL.format(go_id))
     data = r.json()
-    return data['results'][0]['name']
+    _GO_TERM_TEXTS[go_id] = name = data['results'][0]['name']
+    return name
+
+
+def get_go_term_texts(go_ids: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Get the text descriptions of several GO terms, looking up the unknown ones in batches.
+
+    Args:
+        go_ids: The GO term IDs.
+
+    Returns:
+        The text description of each GO term, or None if QuickGO does not know the term.
+    """
+    go_ids = list(dict.fromkeys(go_ids))
+    missing = [go_id for go_id in go_ids if go_id not in _GO_TERM_TEXTS]
+    for i in range(0, len(missing), QUICKGO_BATCH_SIZE):
+        r = _CLIENT.get(QUICKGO_TERMS_URL.format(','.join(missing[i:i + QUICKGO_BATCH_SIZE])))
+        for term in r.json().get('results', []):
+            _GO_TERM_TEXTS[term['id']] = term['name']
+    return {go_id: _GO_TERM_TEXTS.get(go_id) for go_id in go_ids}
@@ -1,30 +1,114 @@
-import json
+import asyncio
 import logging
+from functools import lru_cache
+
+import orjson
 
 from ha import config
 from ha.agent.executor import QueryExecutor
-from ha.models import openai_client as client
+from ha.models import async_openai_client as client
 from ha.neo4j import graphdb
 from ha.tools.kegg import kegg_tips
-from ha.utils import clean_markdown_response
+from ha.utils import build_messages, clean_markdown_response, generative_execution, loads
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Set logging level to ERROR or higher to ignore WARNING messages
 logging.getLogger("neo4j").setLevel(logging.ERROR)
 
 
+@lru_cache(maxsize=8)
+def query_system_message(pathways: str) -> dict:
+    """
+    Builds the system message for choosing the analysis parameters; cached so that repeated requests share the same
+    message.
+
+    Args:
+        pathways: The available pathway titles.
+
+    Returns:
+        The system message.
+    """
+    return {
+        "role": "system",
+        "content": "You are a system that generates queries using JSON template."
+                   "{'node_name': '<node_name>', 'pathway_title': '<pathway_title>', "
+                   "'explanation': '<explanation>'}."
+                   "You only respond with JSON.\n"
+                   f"Choose from the available pathways: {pathways}\n"
+                   "Generate the following JSON object: "
+                   "{\"node_name\": \"<a gene symbol e.g. INSR>\", "
+                   "\"pathway_title\": \"<the exact name of the KEGG pathway; "
+                   "recommended: query for it before hand>\""
+                   "\"explanation\": \"<explanation>\"}\n"
+    }
+
+
+# Every KEGG entry carries the Node label next to its entry type, so that lookups by name are index seeks
+NODE_NAME_INDEX = 'node_name_idx'
+
+# All the network metrics of a node in a pathway, in one round-trip; each subquery runs once and returns one row
+# (aggregations without grouping keys return a row even if nothing matches)
+ANALYSIS_QUERY = """
+CALL {
+    // the subtree of the node that pertains to the pathway, compared to the whole pathway
+    MATCH (root:Node {name: $node_name})-[:CHILD_OF*0..]->(descendant)
+    WHERE $pathway_title IN descendant.pathway_titles
+    WITH count(descendant) AS subtreeNodes
+    MATCH (n:Node)
+    WHERE $pathway_title IN n.pathway_titles
+    WITH subtreeNodes, count(n) AS totalNodes
+    RETURN CASE WHEN totalNodes = 0 THEN 0.0 ELSE subtreeNodes * 1.0 / totalNodes END AS forest_subarea_ratio
+}
+CALL {
+    // from any root of the pathway to the node
+    MATCH (target:Node {name: $node_name})
+    WHERE $pathway_title IN target.pathway_titles
+    // a root has no incoming path, i.e. no incoming relationship, which is a degree check rather than an expansion
+    MATCH (root:Node)
+    WHERE NOT ()-->(root) AND $pathway_title IN root.pathway_titles
+    MATCH path = shortestPath((root)-[*]->(target))
+    WHERE target <> root AND all(n IN nodes(path) WHERE $pathway_title IN n.pathway_titles)
+    RETURN [min(length(path)), max(length(path))] AS root_to_node
+}
+CALL {
+    // from the node to any leaf below it
+    MATCH (n:Node {name: $node_name})
+    WHERE $pathway_title IN n.pathway_titles
+    MATCH path = (n)-[*]->(leaf)
+    WHERE NOT (leaf)-->() AND all(node IN nodes(path) WHERE $pathway_title IN node.pathway_titles)
+    RETURN [min(length(path)), max(length(path))] AS node_to_leaf
+}
+CALL {
+    // from any root of the pathway to any leaf
+    MATCH (n:Node)
+    WHERE $pathway_title IN n.pathway_titles AND NOT ()-->(n) AND (n)--()
+    MATCH path = (n)-[*]->(leaf)
+    WHERE NOT (leaf)-->() AND all(node IN nodes(path) WHERE $pathway_title IN node.pathway_titles)
+    RETURN [min(length(path)), max(length(path))] AS root_to_leaf
+}
+CALL {
+    MATCH (n:Node {name: $node_name})-[]->(child)
+    WHERE $pathway_title IN child.pathway_titles
+    RETURN collect(child.name) AS directly_impacted_nodes
+}
+RETURN forest_subarea_ratio, root_to_node, node_to_leaf, root_to_leaf, directly_impacted_nodes
+"""
+
 class GraphAnalysis(QueryExecutor):
 
     NAME = "Graph Analysis Query Executor"
+    __slots__ = ()
+    # generate_response is a passthrough of the metrics, there is no second call to save
+    COMPAT_TWO_STEP = True
 
     def __init__(self, model: str = config.OPENAI_NEO4J_MODEL, attempts: int = 5):
         super().__init__(model, attempts)
 
-    def generate_query(self, instruction: str, goal_template: str, reflection: str, schema: str,
-                       tips: str = kegg_tips) -> tuple:
+    @generative_execution(speculative=2)
+    async def generate_query(self, instruction: str, goal_template: str, reflection: str, schema: str,
+                             tips: str = kegg_tips) -> tuple:
         """
         Method generates the right .
 
@@ -38,28 +122,18 @@ class GraphAnalysis(QueryExecutor):
         Returns:
             The generated network analysis parameters (gene symbol and ) and explanation.
         """
-        prompt = (f"Given this instruction: {instruction}\n"
-                  f"Choose from the available pathways: {self.get_all_pathways()}\n" # this is a bit of a cheat
-                  f"Generate the following JSON object: "
-                  f"{{\"node_name\": \"<a gene symbol e.g. INSR>\", "
-                  f"\"pathway_title\": \"<the exact name of the KEGG pathway; recommended: query for it before hand>\""
-                  f"\"explanation\": \"<explanation>\"}}\n")
-        response = client.chat.completions.create(
+        prompt = f"Given this instruction: {instruction}\n"
+        # the pathways are read from Neo4j with the blocking driver on first use; in a thread, so other steps can proceed
+        pathways = await asyncio.to_thread(self.get_all_pathways)
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates queries using JSON template."
-                                              "{'node_name': '<node_name>', 'pathway_title': '<pathway_title>', "
-                                              "'explanation': '<explanation>'}."
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
+            # this is a bit of a cheat
+            messages=build_messages(query_system_message(pathways), prompt),
             response_format={"type": "json_object"}
         )
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
+            jsn = loads(clean_markdown_response(response.choices[0].message.content))
+        except (orjson.JSONDecodeError, TypeError):
             logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
             raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
         logger.info(f"I've found the following target node and pathway: {jsn['node_name']} in {jsn['pathway_title']}")
@@ -82,14 +156,13 @@ class GraphAnalysis(QueryExecutor):
 
         - directly_impacted_nodes: a list of nodes (gene symbols) that are directly impacted by the given node in the pathway.
         """
+        self.ensure_indexes()
         node_name = query['node_name']
         pathway_title = query['pathway_title']
         return {
             'node_name': node_name,
             'pathway_title': pathway_title,
-            'forest_subarea_ratio': self.forest_subarea_ratio(node_name, pathway_title),
-            **self.root_and_leaf_distances(node_name, pathway_title),
-            'directly_impacted_nodes': self.get_directly_impacted_nodes(node_name, pathway_title),
+            **self._run_analysis(node_name, pathway_title),
             'note on forest subarea ratio': 'The forest subarea ratio is a metric that indicates '
                                             'the potential impact of a node on a specific pathway. '
                                             'It is calculated as the ratio between nodes in the subtree of a node '
@@ -97,7 +170,7 @@ class GraphAnalysis(QueryExecutor):
                                             'of the same pathway.',
         }
 
-    def generate_response(self, instructions: str, goal_template: str, reflection: str, query_response: str) -> str:
+    async def generate_response(self, instructions: str, goal_template: str, reflection: str, query_response: str) -> str:
         """
         A stub; just returns the query response.
 
@@ -113,185 +186,62 @@ class GraphAnalysis(QueryExecutor):
         return query_response
 
     @staticmethod
-    def forest_subarea_ratio(node_name: str, pathway_title: str) -> float:
-        """
-        Calculates the ratio between nodes in the subtree of a node that pertain to a specific pathway compared to all
-        nodes in the graph of the same pathway.
-
-        The goal of this method is to provide a metric that indicates the potential impact of a node on a specific
-        pathway.
-
-        Args:
-            node_name: The name of the node.
-            pathway_title: The title of the pathway.
-
-        Returns:
-            forest subarea ratio: ratio indicating the potential impact of a node on a specific pathway.
-        """
-        with graphdb.session() as session:
-            result = session.run(
-                """
-                MATCH (root {name: $node_name})-[:CHILD_OF*0..]->(descendant)
-                WHERE $pathway_title IN descendant.pathway_titles
-                WITH count(descendant) AS subtreeNodes
-                MATCH (n)
-                WHERE $pathway_title IN n.pathway_titles
-                WITH subtreeNodes, count(n) AS totalNodes
-                RETURN subtreeNodes * 1.0 / totalNodes AS forest_subarea_ratio
-                """,
-                node_name=node_name, pathway_title=pathway_title).single()
-            if not result:
-                logger.error(f"No result found for forest_subarea_ratio calculation for {node_name} in {pathway_title}.")
-                return 0.0
-            return result['forest_subarea_ratio']
-
-    @staticmethod
-    def get_root_depths(pathway_title) -> dict:
-        """
-        Calculates the minimum and maximum distances between the root of the pathway and any leaf below the node.
-
-        Args:
-            pathway_title: The title of the pathway.
-
-        Returns:
-            A dictionary containing the minimum and maximum distances between the root of the pathway and any leaf below the node.
-        """
-        # Cypher query to find min and max distances
-        query = """
-        MATCH (n)
-        WHERE $pathway_title IN n.pathway_titles
-        AND NOT ()-->(n)  // Ensure n is a root node
-        AND (n)--()       // Exclude singleton nodes
-        
-        MATCH path = (n)-[*]->(leaf)
-        WHERE NOT (leaf)-->()  // Ensure leaf is a leaf node
-        AND all(node in nodes(path) WHERE $pathway_title IN node.pathway_titles)
-
-        RETURN MIN(length(path)) AS min_distance, MAX(length(path)) AS max_distance
-        """
-
-        # Execute the query using the neo4j driver
-        with graphdb.session() as session:
-            return session.run(query, pathway_title=pathway_title).single()
-
-    @staticmethod
-    def get_node_subtree_depths(node_name, pathway_title) -> dict:
-        """
-        Calculates the minimum and maximum distances between the root of the pathway and any leaf below the node.
-
-        Args:
-            node_name: The name of the node.
-            pathway_title: The title of the pathway.
-
-        Returns:
-            A dictionary containing the minimum and maximum distances between the root of the pathway and any leaf below the node.
-        """
-
-        # Cypher query to find min and max distances
-        query = """
-            MATCH (n)
-            WHERE n.name = $node_name AND $pathway_title IN n.pathway_titles
-
-            MATCH path = (n)-[*]->(leaf)
-            WHERE NOT (leaf)-->()  // Ensure leaf is a leaf node
-            AND all(node in nodes(path) WHERE $pathway_title IN node.pathway_titles)
-
-            RETURN MIN(length(path)) AS min_distance, MAX(length(path)) AS max_distance
-            """
-
-        # Execute the query using the neo4j driver
-        with graphdb.session() as session:
-            return session.run(query, node_name=node_name, pathway_title=pathway_title).single()
-
-    @staticmethod
-    def get_roots_to_node_distances(node_name: str, pathway_title: str) -> dict:
+    @lru_cache(maxsize=1)
+    def ensure_indexes():
         """
-        Calculates the minimum and maximum distances between a root of the pathway and the chosen node.
-
-        Args:
-            node_name: The name of the node.
-            pathway_title: The title of the pathway.
-
-        Returns:
-            A dictionary containing the minimum and maximum distances between the root of the pathway and the chosen node.
+        Makes sure that the name index the analysis relies on exists; runs once per process. Graphs imported before
+        the Node label was introduced are labelled first.
         """
-        # Cypher query to find min and max distances
-        query = """
-            MATCH (target)
-            WHERE target.name = $node_name
-            AND $pathway_title IN target.pathway_titles
-            
-            WITH target
-            
-            MATCH (root)
-            WHERE NOT ()-[*]->(root) 
-            AND $pathway_title IN root.pathway_titles
-            
-            WITH root, target
-            MATCH path = shortestPath((root)-[*]->(target))
-            WHERE target <> root AND all(n IN nodes(path) WHERE $pathway_title IN n.pathway_titles)
-            RETURN min(length(path)) AS min_distance, max(length(path)) AS max_distance
-            """
-
-        # Execute the query using the neo4j driver
-        with graphdb.session() as session:
-            return session.run(query, node_name=node_name, pathway_title=pathway_title).single()
-
-    def root_and_leaf_distances(self, node_name: str, pathway_title: str) -> dict:
-        """
-        Calculates a few metrics based on distances between a chosen node, the root(s) of the current pathway above
-        the node, and the leaves of the pathway below the node.
-        - root_to_node: depth measured from any root to the node
-        - node_to_leaf: depth measured from the node to any leaf
-        - root_to_leaf: depth measured from any root to any leaf below the node
-        """
-        root_to_node = self.get_roots_to_node_distances(node_name, pathway_title)
-        node_to_leaf = self.get_node_subtree_depths(node_name, pathway_title)
-        root_to_leaf = self.get_root_depths(pathway_title)
+        from neo4j import RoutingControl
 
-        return {
-            'root_to_node': root_to_node,
-            'node_to_leaf': node_to_leaf,
-            'root_to_leaf': root_to_leaf
-        }
+        existing = {record['name'] for record in graphdb.execute_query("SHOW INDEXES YIELD name",
+                                                                      routing_=RoutingControl.READ).records}
+        if NODE_NAME_INDEX in existing:
+            return
+        logger.info(f"Creating the {NODE_NAME_INDEX} index.")
+        graphdb.execute_query("MATCH (n) WHERE n.pathway_titles IS NOT NULL AND NOT n:Node SET n:Node")
+        graphdb.execute_query(f"CREATE INDEX {NODE_NAME_INDEX} IF NOT EXISTS FOR (n:Node) ON (n.name)")
 
     @staticmethod
-    def get_directly_impacted_nodes(node_name: str, pathway_title: str) -> list:
+    def _run_analysis(node_name: str, pathway_title: str) -> dict:
         """
-        Returns the nodes that are directly impacted by the given node in the pathway.
+        Runs all the network metrics of a node in a pathway in a single query (see ANALYSIS_QUERY).
 
         Args:
             node_name: The name of the node.
             pathway_title: The title of the pathway.
 
         Returns:
-            A list of nodes that are directly impacted by the given node in the pathway.
-        """
-        #TODO: NOTE -- unsure if this is needed at this point.
-
-        # Cypher query to find directly impacted nodes
-        query = """
-            MATCH (n)
-            WHERE n.name = $node_name
-            WITH n
-            MATCH (n)-[r]->(child)
-            WHERE $pathway_title IN child.pathway_titles
-            RETURN child.name AS directly_impacted_node
-            """
-        # Execute the query using the neo4j driver
-        with graphdb.session() as session:
-            result = session.run(query, node_name=node_name, pathway_title=pathway_title)
-            # Extract the 'directly_impacted_node' values from the result
-            return [record['directly_impacted_node'] for record in result]
+            A dictionary with the forest subarea ratio, the [min, max] distances root_to_node, node_to_leaf and
+            root_to_leaf, and the directly impacted nodes.
+        """
+        from neo4j import RoutingControl
+
+        records = graphdb.execute_query(ANALYSIS_QUERY, node_name=node_name, pathway_title=pathway_title,
+                                        routing_=RoutingControl.READ).records
+        if not records:
+            logger.error(f"No result found for the network analysis of {node_name} in {pathway_title}.")
+            return {
+                'forest_subarea_ratio': 0.0,
+                'root_to_node': [None, None],
+                'node_to_leaf': [None, None],
+                'root_to_leaf': [None, None],
+                'directly_impacted_nodes': [],
+            }
+        return records[0].data()
 
     @staticmethod
+    @lru_cache(maxsize=1)
     def get_all_pathways() -> str:
         """
-        Retrieves all KEGG pathways from the Neo4j database.
+        Retrieves all KEGG pathways from the Neo4j database. The pathways do not change while the agent runs, so
+        they are only read once; use GraphAnalysis.get_all_pathways.cache_clear() to read them again.
 
         Returns:
             A list of all KEGG pathways.
         """
-        with graphdb.session() as session:
-            results = session.run("MATCH (p:Pathway) RETURN p.title AS pathway_title")
-            return '"' + '", "'.join([record['pathway_title'] for record in results]) + '"'
+        from neo4j import RoutingControl
+
+        records = graphdb.execute_query("MATCH (p:Pathway) RETURN p.title AS pathway_title",
+                                        routing_=RoutingControl.READ).records
+        return '"' + '", "'.join([record['pathway_title'] for record in records]) + '"'
@@ -1,13 +1,15 @@
-import json
+import asyncio
 import logging
-from typing import Tuple
+from typing import Dict, List, Tuple
 
-from ha.models import openai_client as client
+import orjson
+
+from ha.agent.exact_cache import exact_cache
+from ha.models import async_openai_client as client
 from ha import config
-from ha.utils import generative_execution, clean_markdown_response
+from ha.utils import ActionLog, build_messages, generative_execution, clean_markdown_response, dumps, loads
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
@@ -17,6 +19,84 @@ tips = """
 - use the objective and expand it in the context of the tool and its capabilities.
 """
 
+INSTRUCTIONS_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates instructions using a JSON template."
+               "{'instructions': '<instructions here>', "
+               "'goal_template': '<explanation here>'}."
+               "You only respond with JSON.\n"
+               "Generate a detailed instruction for completing the objective using "
+               "the designated tool.\n"
+               "Remember that this should be done in only ONE step using the tool.\n"
+               "Include a JSON goal template for the output data structure that would "
+               "satisfy the request. Use the provided schema to identify what "
+               "information types are important or can be derived from the "
+               "tool data source.\n"
+               "If none is required use 'flexible' to leave it to the executor.\n"
+               f"Use these tips: {tips}\n"
+}
+# the tool and its schema come first, so that the prompts of the same tool share their prefix
+INSTRUCTIONS_PROMPT = ("Tool: {tool}\n"
+                       "Relevant Schema: {schema}\n\n"
+                       "Objective: {objective}\n"
+                       "Use this reflection if available <<{reflection}>>\n")
+
+REFLECT_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates judgements using a JSON template."
+               "Your response should follow this format:\n"
+               "{'acceptance': true/false, 'reflection': '<reflection here>'}"
+               "You only respond with JSON.\n"
+               "You will be given an objective, the tool that is supposed to be used "
+               "to complete it, and detailed instructions with an output data "
+               "template. You should reflect and decide whether:\n"
+               "1. The instructions will lead to an appropriate answer to the "
+               "objective.\n"
+               "2. The instructions can realistically be followed using the "
+               "specified tool.\n"
+               "3. Determine if the data goal template is appropriate WRT the "
+               "objective."
+}
+REFLECT_PROMPT = ("Objective: <<{objective}>>\n"
+                  "Tool: <<{tool}>>\n--\n"
+                  "Detailed instructions and output data template:\n{instructions}\n")
+
+# the same, for all the items of a plan in one request
+INSTRUCTIONS_BATCH_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates instructions using a JSON template."
+               "{'results': [{'instructions': '<instructions here>', "
+               "'goal_template': '<explanation here>'}, ...]}."
+               "You only respond with JSON.\n"
+               "You will be given a numbered list of items, each an objective with its designated tool. "
+               "Generate a detailed instruction for completing each objective using its tool, with exactly one "
+               "result per item and in the same order.\n"
+               "Remember that each should be done in only ONE step using the tool.\n"
+               "Include a JSON goal template for the output data structure that would "
+               "satisfy each request. Use the provided schemas to identify what "
+               "information types are important or can be derived from the "
+               "tool data source.\n"
+               "If none is required use 'flexible' to leave it to the executor.\n"
+               f"Use these tips: {tips}\n"
+}
+
+REFLECT_BATCH_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates judgements using a JSON template."
+               "Your response should follow this format:\n"
+               "{'results': [{'acceptance': true/false, 'reflection': '<reflection here>'}, ...]}"
+               "You only respond with JSON.\n"
+               "You will be given a numbered list of items, each an objective, the tool that is supposed to be used "
+               "to complete it, and detailed instructions with an output data "
+               "template. For each item, in the same order, you should reflect and decide whether:\n"
+               "1. The instructions will lead to an appropriate answer to the "
+               "objective.\n"
+               "2. The instructions can realistically be followed using the "
+               "specified tool.\n"
+               "3. Determine if the data goal template is appropriate WRT the "
+               "objective."
+}
+
 
 class Instructor:
 
@@ -26,9 +106,9 @@ class Instructor:
         self.model = model
         self.attempts = 3
         self.default_attempts = 3
-        self.action_log = []
+        self.action_log = ActionLog()
 
-    def run(self, objective: str, tool: str, schema: str, reflection: str = '') -> dict:
+    async def run(self, objective: str, tool: str, schema: str, reflection: str = '') -> dict:
         """
         Runs the instructor. This is the main method that should be called to run the instructor.
 
@@ -41,43 +121,106 @@ class Instructor:
         Returns:
             The detailed instructions for the agent.
         """
-        self.attempts = self.default_attempts
-        return self._run(objective, tool, schema, reflection)
+        cache_key = self._cache_key(objective, tool, schema)
+        cached = exact_cache.get(cache_key) if not reflection else None
+        if cached is not None:
+            logger.info(f"{self.NAME} reuses the instructions of the same objective.")
+            return loads(cached)
+        instructions = await self._run(objective, tool, schema, reflection)
+        if "error" not in instructions:
+            exact_cache.put(cache_key, dumps(instructions))
+        return instructions
 
-    def _run(self, objective: str, tool: str, schema: str, reflection: str = '') -> dict:
+    async def run_batch(self, items: List[Dict]) -> List[dict]:
         """
-        Runs the instructor. This is hidden in order to keep the attempts counter intact.
+        Runs the instructor for several objectives at once. The instructions of all the objectives are generated in
+        one request and reflected upon in another; only the rejected ones are retried one by one.
+
+        Args:
+            items: The objectives, each a dictionary with an objective, a tool and a schema.
+
+        Returns:
+            The detailed instructions for each item, in the same order.
+        """
+        cache_keys = [self._cache_key(item["objective"], item["tool"], item["schema"]) for item in items]
+        results: List = [exact_cache.get(cache_key) for cache_key in cache_keys]
+        results = [loads(cached) if cached is not None else None for cached in results]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if len(pending) < 2:
+            for i in pending:
+                results[i] = await self.run(**items[i])
+            return results
+
+        batch = [items[i] for i in pending]
+        generated = await self.generate_instructions_batch(batch)
+        judgements = await self.reflect_batch(batch, generated) if isinstance(generated, list) else generated
+        if not isinstance(judgements, list):
+            logger.warning(f"{self.NAME} could not handle the batch, running one by one: {judgements.get('error')}")
+            runs = await asyncio.gather(*[self.run(**item) for item in batch])
+            for i, result in zip(pending, runs):
+                results[i] = result
+            return results
+
+        retries = {}
+        for i, item, instructions, (reflection_success, reflection) in zip(pending, batch, generated, judgements):
+            self.log(item["objective"], item["tool"], instructions, reflection_success, reflection, 1)
+            if reflection_success:
+                results[i] = instructions
+                exact_cache.put(cache_keys[i], dumps(instructions))
+            else:
+                retries[i] = self._run(item["objective"], item["tool"], item["schema"], reflection, attempt=2)
+        for i, result in zip(retries, await asyncio.gather(*retries.values())):
+            results[i] = result
+        return results
+
+    def _cache_key(self, objective: str, tool: str, schema: str) -> str:
+        """
+        Returns the cache key of the accepted instructions for an objective. Instructions are only reused for the same
+        objective on the same tool: the case and whitespace of the objective are ignored, anything else (a paraphrase
+        may name other genes or pathways) makes it a different objective.
+        """
+        normalised = " ".join(objective.casefold().split())
+        return exact_cache.key(self.model, ['instructions', tool, schema, normalised])
+
+    async def _run(self, objective: str, tool: str, schema: str, reflection: str = '', attempt: int = 1) -> dict:
+        """
+        Runs the instructor, retrying until the reflection accepts the instructions or the attempts run out. The
+        attempts are counted locally so that concurrent runs on the same instructor do not interfere.
 
         Args:
             objective: Objective based on the plan
             tool: The tool based on the plan
             schema: The schema for the query
             reflection: The user's reflection on the previous response
+            attempt: The attempt to start at, starting at 1; later when earlier attempts were made elsewhere
 
         Returns:
             The detailed instructions for the agent.
         """
-        instructions = self.generate_instructions(objective, tool, schema, reflection)
-        instructions_str = json.dumps(instructions) # Convert the instructions back to string; not great
-        reflection_success, reflection = self.reflect(objective, tool, instructions_str)
-        self.attempts -= 1
-        self.log(objective, tool, instructions, reflection_success, reflection)
-        if reflection_success:
-            logger.info(f"{self.NAME} thinks their answer is correct.")
-            return instructions
-        elif self.attempts:
-            logger.info(f"{self.NAME} thinks their answer is incorrect because: {reflection}. Retrying... Attempts left: {self.attempts}")
-            return self._run(objective, tool, reflection)
-        else:
-            logger.error(f"{self.NAME} failed after {self.default_attempts} attempts. Passing the log.")
-            return ({
-                "error": f"Reflection failed after {self.default_attempts} attempts.",
-                "log": self.action_log
-            })
+        for attempt in range(attempt, self.attempts + 1):
+            generated = await self.generate_instructions(objective, tool, schema, reflection)
+            # the raw response is reflected upon as is; only a failed generation (an error dict) is serialised
+            if isinstance(generated, tuple):
+                instructions, instructions_str = generated
+            else:
+                instructions, instructions_str = generated, dumps(generated)
+            reflection_success, reflection = await self.reflect(objective, tool, instructions_str)
+            self.log(objective, tool, instructions, reflection_success, reflection, attempt)
+            if reflection_success:
+                logger.info(f"{self.NAME} thinks their answer is correct.")
+                return instructions
+            if attempt < self.attempts and logger.isEnabledFor(logging.INFO):
+                logger.info(f"{self.NAME} thinks their answer is incorrect because: {reflection}. Retrying... Attempts left: {self.attempts - attempt}")
 
+        logger.error(f"{self.NAME} failed after {self.default_attempts} attempts. Passing the log.")
+        return ({
+            "error": f"Reflection failed after {self.default_attempts} attempts.",
+            "log": list(self.action_log)
+        })
 
     @generative_execution
-    def generate_instructions(self, objective: str, tool: str, schema: str, reflection: str = 'not available') -> dict:
+    async def generate_instructions(self, objective: str, tool: str, schema: str,
+                                    reflection: str = 'not available') -> Tuple[dict, str]:
         """
         Generates detailed instructions for the agent based on the short instructions.
 
@@ -88,46 +231,97 @@ class Instructor:
             reflection: The user's reflection on the previous response
 
         Returns:
-            The detailed instructions for the agent.
+            The detailed instructions for the agent, and the response they were parsed from.
         """
-        prompt = (
-            f"Generate a detailed instruction for completing the objective using the designated tool.\n"
-            f"Remember that this should be done in only ONE step using the tool.\n"
-            f"Include a JSON goal template for the output data structure that would satisfy the request. "
-            f"Use the provided schema to identify what information types are important or can be derived from the"
-            f"tool data source.\n"
-            f"If none is required use 'flexible' to leave it to the executor.\n"
-            f"Objective: {objective}\n"
-            f"Tool: {tool}\n"
-            f"Relevant Schema: {schema}\n\n"
-            f"Use this reflection if available <<{reflection}>>\n"
-            f"And these tips: {tips}\n"
-        )
+        prompt = INSTRUCTIONS_PROMPT.format(tool=tool, schema=schema, objective=objective, reflection=reflection)
 
         # Send the image and text prompt to GPT-4 with Vision
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates instructions using a JSON template."
-                                              "{'instructions': '<instructions here>', "
-                                              "'goal_template': '<explanation here>'}."
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
+            messages=build_messages(INSTRUCTIONS_SYSTEM_MESSAGE, prompt),
             response_format={"type": "json_object"}
         )
 
         # Extract the response from the assistant and parse as JSON; important to validate the output at this point
+        content = clean_markdown_response(response.choices[0].message.content)
         try:
-            return json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
+            return loads(content), content
+        except (orjson.JSONDecodeError, TypeError):
             logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
             raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
 
     @generative_execution
-    def reflect(self, objective: str, tool: str, instructions: str) -> Tuple[bool, str]:
+    async def generate_instructions_batch(self, items: List[Dict]) -> List[dict]:
+        """
+        Generates detailed instructions for several objectives in a single request.
+
+        Args:
+            items: The objectives, each a dictionary with an objective, a tool and a schema.
+
+        Returns:
+            The detailed instructions for each item, in the same order.
+        """
+        # every tool's schema is listed once, however many items use it
+        schemas = {item["tool"]: item["schema"] for item in items}
+        prompt = "".join(f"Tool: {tool}\nRelevant Schema: {schema}\n\n" for tool, schema in schemas.items())
+        prompt += "".join(f"Item {i}:\nTool: {item['tool']}\nObjective: {item['objective']}\n"
+                          for i, item in enumerate(items, 1))
+        response = await client.chat.completions.create(
+            model=self.model,
+            messages=build_messages(INSTRUCTIONS_BATCH_SYSTEM_MESSAGE, prompt),
+            response_format={"type": "json_object"}
+        )
+        content = response.choices[0].message.content
+        try:
+            results = loads(clean_markdown_response(content))["results"]
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            logger.error(f"Failed to decode JSON response from {self.model}. Response: {content}")
+            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {content}")
+        if len(results) != len(items):
+            raise ValueError(f"Expected instructions for {len(items)} items, got {len(results)}.")
+        return results
+
+    @generative_execution
+    async def reflect_batch(self, items: List[Dict], instructions: List[dict]) -> List[Tuple[bool, str]]:
+        """
+        Reflects on the generated instructions of several objectives in a single request.
+
+        Args:
+            items: The objectives, each a dictionary with an objective and a tool.
+            instructions: The generated instructions for each item, in the same order.
+
+        Returns:
+            A list of tuples containing a boolean indicating if the instructions are appropriate and a reflection
+            message, one per item.
+        """
+        logger.info(f"Reflecting on the instructions of {len(items)} items.")
+        prompt = "".join(f"Item {i}:\nObjective: <<{item['objective']}>>\nTool: <<{item['tool']}>>\n--\n"
+                         f"Detailed instructions and output data template:\n{dumps(item_instructions)}\n\n"
+                         for i, (item, item_instructions) in enumerate(zip(items, instructions), 1))
+        messages = build_messages(REFLECT_BATCH_SYSTEM_MESSAGE, prompt)
+        cache_key = exact_cache.key(self.model, messages, temperature=0.0)
+        content = exact_cache.get(cache_key)
+        if content is None:
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.0,
+                response_format={"type": "json_object"}
+            )
+            content = response.choices[0].message.content
+        try:
+            judgements = [(jsn["acceptance"], jsn["reflection"])
+                          for jsn in loads(clean_markdown_response(content))["results"]]
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            logger.error(f"Failed to decode JSON response from {self.model}. Response: {content}")
+            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {content}")
+        if len(judgements) != len(items):
+            raise ValueError(f"Expected judgements for {len(items)} items, got {len(judgements)}.")
+        exact_cache.put(cache_key, content)
+        return judgements
+
+    @generative_execution
+    async def reflect(self, objective: str, tool: str, instructions: str) -> Tuple[bool, str]:
         """
         Reflects on the generated instructions and determines if they are appropriate and satisfactory. If so,
         the method should return True and a reflection message. If not, the method should return False and
@@ -142,40 +336,34 @@ class Instructor:
             A tuple containing a boolean indicating if the instructions are appropriate and a reflection message.
         """
         logger.info(f"Reflecting on the instructions.")
-        prompt = (f"Consider the following objective: <<{objective}>>\n"
-                  f"And the tool that is supposed to be used to complete it: <<{tool}>>\n--\n"
-                  f"Now determine if the following detailed instructions and "
-                  f"output data template are appropriate:\n{instructions}\n--\n"
-                  f"You should reflect and decide whether:\n"
-                  f"1. The instructions will lead to an appropriate answer to the objective.\n"
-                  f"2. The instructions can realistically be followed using the specified tool.\n"
-                  f"3. Determine if the data goal template is appropriate WRT the objective.")
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates judgements using a JSON template."
-                                              "Your response should follow this format:\n"
-                                              "{'acceptance': true/false, 'reflection': '<reflection here>'}"
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
-            response_format={"type": "json_object"}
-        )
+        prompt = REFLECT_PROMPT.format(objective=objective, tool=tool, instructions=instructions)
+        messages = build_messages(REFLECT_SYSTEM_MESSAGE, prompt)
+        # the same instructions for the same objective gets the same judgement
+        cache_key = exact_cache.key(self.model, messages, temperature=0.0)
+        content = exact_cache.get(cache_key)
+        if content is None:
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.0,
+                response_format={"type": "json_object"}
+            )
+            content = response.choices[0].message.content
 
         # Extract the response from the assistant
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
-            logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
-            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
+            jsn = loads(clean_markdown_response(content))
+        except (orjson.JSONDecodeError, TypeError):
+            logger.error(f"Failed to decode JSON response from {self.model}. Response: {content}")
+            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {content}")
         acceptance = jsn["acceptance"]
         reflection = jsn["reflection"]
+        exact_cache.put(cache_key, content)
 
         return acceptance, reflection
 
-    def log(self, objective: str, tool: str, instructions: dict, reflection_success: bool, reflection: str):
+    def log(self, objective: str, tool: str, instructions: dict, reflection_success: bool, reflection: str,
+            attempt: int):
         """
         Logs the action taken by the instructor.
 
@@ -185,6 +373,7 @@ class Instructor:
             instructions: The detailed instructions for the agent.
             reflection_success: Whether the reflection was successful.
             reflection: The reflection on the query response.
+            attempt: The attempt number, starting at 1.
         """
         self.action_log.append(
             {
@@ -193,6 +382,6 @@ class Instructor:
                 "instructions": instructions,
                 "reflection_success": reflection_success,
                 "reflection": reflection,
-                "attempt": self.default_attempts - self.attempts,
+                "attempt": attempt,
             }
         )
\ No newline at end of file
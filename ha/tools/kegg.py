@@ -1,22 +1,26 @@
-import json
 import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
 from typing import Union, Dict, List
 
-from neo4j.exceptions import CypherSyntaxError, CypherTypeError
+import orjson
 
 from ha.agent.executor import QueryExecutor
-from ha.models import openai_client as client
+from ha.models import async_openai_client as client
 from ha.neo4j import graphdb
 from ha import config
-from ha.utils import generative_execution, clean_markdown_response
+from ha.utils import build_messages, generative_execution, clean_markdown_response, dumps, loads
 
 # Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
 kegg_tips = """
 - use the `pathway_titles` attribute (a list) to filter for diseases
+- every entry has the `Node` label; use it in patterns, e.g. MATCH (n:Node) rather than MATCH (n)
 - don't be overly specific with the query
 - use lower case when trying to match names, e.g. toLower(toString(x)) = 'cancer'
 - always use toString() when making string comparison operations or matching
@@ -26,17 +30,101 @@ kegg_tips = """
 """
 
 
+@lru_cache(maxsize=8)
+def query_system_message(schema: str, tips: str) -> dict:
+    """
+    Builds the system message for Cypher query generation; cached so that repeated requests share the same message.
+
+    Args:
+        schema: The Neo4j schema.
+        tips: The tips to provide to the assistant.
+
+    Returns:
+        The system message.
+    """
+    return {
+        "role": "system",
+        "content": "You are a system that generates queries using JSON template."
+                   "{'query': '<query here>', 'explanation': '<explanation here>'}."
+                   "You only respond with JSON.\n"
+                   f"Given the following Neo4j schema:\n{schema}\n"
+                   f"Use these tips: {tips}"
+    }
+
+
+# upper bound on the records a query returns, whatever the generated query asks for; the records past it are
+# discarded by the driver without being turned into dictionaries
+MAX_RESULT_ROWS = 100
+
+
+class QueryCache:
+    """
+    A small LRU cache of query results with a time to live. The queries run in worker threads, so every access is
+    taken under a lock, and the callers get a copy of the cached records that they are free to change.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str, ttl: float):
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= ttl:
+                del self._entries[query]
+                return None
+            self._entries.move_to_end(query)
+            result = entry[1]
+        return [dict(record) for record in result]
+
+    def put(self, query: str, result: list):
+        result = [dict(record) for record in result]
+        with self._lock:
+            self._entries[query] = (time.monotonic(), result)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# generated queries repeat across retries and plan runs
+QUERY_CACHE = QueryCache(maxsize=256)
+
+
+def _first_records(result) -> tuple:
+    # a result transformer; only the first MAX_RESULT_ROWS records are fetched and converted, and the summary tells
+    # whether the query changed the graph. One more record is fetched to tell whether the result was cut, in which
+    # case a marker closes it so that counts and "list all" answers are not taken from partial data
+    records = [record.data() for record in islice(result, MAX_RESULT_ROWS + 1)]
+    if len(records) > MAX_RESULT_ROWS:
+        records[MAX_RESULT_ROWS:] = [{"truncated": f"truncated after {MAX_RESULT_ROWS} of {MAX_RESULT_ROWS + 1}+ "
+                                                   f"records; aggregate in the query (e.g. count()) for totals"}]
+    return records, result.consume()
+
+
+QUERY_PROMPT = ("Take into account the goal data template if relevant: {goal_template}\n"
+                "Use this reflection {reflection}\n"
+                "Generate a Neo4j query that satisfies this instruction: {instruction}")
+
+
 class Kegg(QueryExecutor):
 
     NAME = "KEGG Query Executor"
+    __slots__ = ()
 
     def __init__(self, model=config.OPENAI_NEO4J_MODEL, attempts: int = 5):
         super().__init__(model, attempts)
 
 
     @generative_execution
-    def generate_query(self, instruction: str, goal_template: str, reflection: str, schema: str,
-                       tips: str = kegg_tips) -> tuple:
+    async def generate_query(self, instruction: str, goal_template: str, reflection: str, schema: str,
+                             tips: str = kegg_tips) -> tuple:
         """
         Method that uses OpenAI to generate a Neo4j query given a Neo4j schema and a request.
 
@@ -50,30 +138,19 @@ class Kegg(QueryExecutor):
         Returns:
             The generated Neo4j query and explanation.
         """
-        prompt = (f"Given the following Neo4j schema:\n{schema}\n"
-                  f"Use this reflection {reflection}\n"
-                  f"And these tips: {tips}\n"
-                  f"Take into account the goal data template if relevant: {goal_template}"
-                  f"Generate a Neo4j query that satisfies this instruction: {instruction}")
+        prompt = QUERY_PROMPT.format(goal_template=goal_template, reflection=reflection, instruction=instruction)
 
         # Send the image and text prompt to GPT-4 with Vision
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates queries using JSON template."
-                                              "{'query': '<query here>', 'explanation': '<explanation here>'}."
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
+            messages=build_messages(query_system_message(schema, tips), prompt),
             response_format={"type": "json_object"}
         )
 
         # Extract the response from the assistant
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
+            jsn = loads(clean_markdown_response(response.choices[0].message.content))
+        except (orjson.JSONDecodeError, TypeError):
             raise ValueError("Failed to decode JSON response from OpenAI.")
         query = jsn["query"]
         explanation = jsn["explanation"]
@@ -84,10 +161,11 @@ class Kegg(QueryExecutor):
         """
         Method that retrieves the schema from Neo4j using CALL apoc.meta.schema().
         """
-        with graphdb.session() as session:
-            schema_results = session.run("CALL apoc.meta.schema()")
-            schema = schema_results.single()
-            return json.dumps(schema, default=str)
+        from neo4j import RoutingControl
+
+        records = graphdb.execute_query("CALL apoc.meta.schema()", routing_=RoutingControl.READ).records
+        schema = records[0] if records else None
+        return dumps(schema)
 
     def execute_query(self, query: str) -> list:
         """
@@ -99,15 +177,25 @@ class Kegg(QueryExecutor):
         Returns:
             The result of the query.
         """
+        from neo4j.exceptions import CypherSyntaxError, CypherTypeError
+
         logger.info(f"Executing query: {query}")
+        # only the results of queries that did not change the graph are cached, so a query that writes (a clause or a
+        # procedure such as apoc.refactor.mergeNodes) is never found in the cache and always runs
+        cached = QUERY_CACHE.get(query, config.KEGG_CACHE_TTL) if config.KEGG_CACHE_TTL > 0 else None
+        if cached is not None:
+            return cached
         try:
-            with graphdb.session() as session:
-                result = session.run(query)
-                return [record.data() for record in result]
+            # the records are turned into dictionaries as they are streamed, without keeping the records around
+            result, summary = graphdb.execute_query(query, result_transformer_=_first_records)
         except CypherSyntaxError as e:
             return [{"error": str(e)}]
         except CypherTypeError as e:
             return [{"error": str(e)}]
+        if (config.KEGG_CACHE_TTL > 0 and not summary.counters.contains_updates
+                and not summary.counters.contains_system_updates):
+            QUERY_CACHE.put(query, result)
+        return result
 
     def cast_query(self, query: Union[Dict,List]) -> str:
         """
@@ -119,4 +207,4 @@ class Kegg(QueryExecutor):
         Returns:
             The query result as a string.
         """
-        return json.dumps(query, indent=2)
+        return orjson.dumps(query, default=str, option=orjson.OPT_INDENT_2).decode()
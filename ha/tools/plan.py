@@ -1,25 +1,41 @@
-import json
+import asyncio
 import logging
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
+
+import orjson
 
 from ha import config
-from ha.models import openai_client as client
+from ha.agent.exact_cache import exact_cache
+from ha.models import async_openai_client as client
 from ha.tools.instructor import Instructor
 from ha.tools.kegg import Kegg
 from ha.tools.gaf import Gaf
 from ha.tools.graph import GraphAnalysis
-from ha.utils import generative_execution, clean_markdown_response
+from ha.utils import build_messages, generative_execution, clean_markdown_response, dumps, loads
 
 
 # set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+REFLECT_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a system that generates judgements using a JSON template."
+               "Your response should follow this format:\n"
+               "{'acceptance': true/false, 'reflection': '<reflection here>'}"
+               "You only respond with JSON.\n"
+               "Reflect on the following plan that is being executed."
+}
+
 
 class PlanExecutor:
 
     NAME = "Plan Executor"
 
+    # Upper bound on plan items that are executed at the same time
+    MAX_CONCURRENT_STEPS = 8
+    # Executed items shown to the reflection; older ones are left out so that the prompt does not grow with the plan
+    REFLECT_HISTORY = 3
+
     tool_registry = {
         "kegg_query": Kegg(),
         "gaf_query": Gaf(),
@@ -30,51 +46,138 @@ class PlanExecutor:
         self.todo: list = []
         self.focus: Any = None
         self.done: list = []
+        # the reflections on completed items; they run while the next items proceed
+        self._reflections: list = []
         self.instructor = Instructor()
         self.model = model
 
-    def run(self, plan: List[Dict]) -> List[Dict]:
+    async def run(self, plan: List[Dict]) -> List[Dict]:
         """
         Runs the plan executor. This is the main method that should be called to run the plan executor.
 
-        The plan is a list of dictionaries. Each item in the plan should have an objective and a tool name.
+        The plan is a list of dictionaries. Each item in the plan should have an objective and a tool name. If every
+        item also lists the (0-based) indices of the items it depends on under 'depends_on', independent items are
+        executed concurrently, one dependency layer at a time. Otherwise the plan is executed sequentially. The
+        instructions only depend on the objectives, so those of all the items are generated upfront in one batch.
 
         Args:
             plan: The plan to execute.
 
         Returns:
-            The result of the plan execution.
+            The result of the plan execution, in plan order.
         """
         self._reset()
         self.todo = plan.copy()
-        counter = 0
-        while self.todo:
-            self.focus = self.todo.pop(0)
-            tool = self.tool_registry[self.focus["tool"]]
-            instructions_obj = self.instructor.run(
-                objective=self.focus["objective"],
-                tool=self.focus["tool"],
-                schema=tool.get_schema()
-            )
-            completed = tool.run(instructions_obj["instructions"], instructions_obj["goal_template"])
-            acceptance, feedback = self.reflect(completed)
-            if not acceptance:
-                # TODO: add a planner to re-plan the item here
-                pass
-            counter += 1
-            logger.info(f"Item completed: {counter}")
-            self.done.append(
-                {
-                    "objective": self.focus["objective"],
-                    "tool": self.focus["tool"],
-                    "instructions": instructions_obj,
-                    "feedback": feedback,
-                    "response": completed
-                }
-            )
+        instructions = await self.instructor.run_batch([
+            {"objective": item["objective"], "tool": item["tool"], "schema": self.tool_registry[item["tool"]].schema}
+            for item in plan
+        ])
+        layers = self.layers(plan)
+        if layers is None:
+            for instructions_obj in instructions:
+                self.focus = self.todo.pop(0)
+                await self._run_step(self.focus, instructions_obj)
+            await asyncio.gather(*self._reflections)
+            return self.done
+
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_STEPS)
+
+        async def bounded(item: dict, instructions_obj: dict) -> dict:
+            async with semaphore:
+                return await self._run_step(item, instructions_obj)
+
+        results = {}
+        for layer in layers:
+            for i in layer:
+                self.todo.remove(plan[i])
+            done = await asyncio.gather(*[bounded(plan[i], instructions[i]) for i in layer])
+            results.update(zip(layer, done))
+        self.done = [results[i] for i in range(len(plan))]
+        await asyncio.gather(*self._reflections)
         return self.done
 
-    def execute_item(self, instructions_text: str, tool_name: str, goal_template: str) -> str:
+    async def _run_step(self, item: dict, instructions_obj: dict) -> dict:
+        """
+        Executes a single plan item: runs the tool on its instructions and starts the reflection on the result. The
+        reflection is not waited for; its feedback is filled in once it is done, at the latest by the end of run.
+
+        Args:
+            item: The plan item with an objective and a tool name.
+            instructions_obj: The instructions for the tool, see Instructor.run.
+
+        Returns:
+            The completed item with its instructions, feedback and response.
+        """
+        tool = self.tool_registry[item["tool"]]
+        completed = await tool.run(instructions_obj["instructions"], instructions_obj["goal_template"])
+        done = {
+            "objective": item["objective"],
+            "tool": item["tool"],
+            "instructions": instructions_obj,
+            "feedback": None,
+            "response": completed
+        }
+        # the reflection sees the execution state as of this item, whatever has happened by the time it runs
+        reflection = asyncio.create_task(self.reflect(completed, done=list(self.done), todo=list(self.todo)))
+        reflection.add_done_callback(lambda task: self._attach_feedback(done, task))
+        self._reflections.append(reflection)
+        self.done.append(done)
+        logger.info(f"Item completed: {len(self.done)}")
+        return done
+
+    @staticmethod
+    def _attach_feedback(done: dict, reflection: asyncio.Task):
+        """
+        Fills in the feedback of a completed item once its reflection is done.
+
+        Args:
+            done: The completed item.
+            reflection: The finished reflection task, see reflect.
+        """
+        if reflection.cancelled() or reflection.exception() is not None:
+            return
+        result = reflection.result()
+        if not isinstance(result, tuple):
+            # the reflection failed to produce a judgement; pass the error along
+            done["feedback"] = result
+            return
+        acceptance, done["feedback"] = result
+        if not acceptance:
+            # TODO: add a planner to re-plan the item here
+            pass
+
+    @staticmethod
+    def layers(plan: List[Dict]) -> Optional[List[List[int]]]:
+        """
+        Groups the plan items into layers that can be executed concurrently, based on their 'depends_on' indices.
+
+        Args:
+            plan: The plan to group.
+
+        Returns:
+            A list of layers, each a list of item indices, or None if the plan has no (valid) dependency information.
+        """
+        if not plan or not all(isinstance(item.get("depends_on"), list) for item in plan):
+            return None
+        dependencies = []
+        for i, item in enumerate(plan):
+            depends_on = set(item["depends_on"])
+            if not all(isinstance(d, int) and 0 <= d < len(plan) and d != i for d in depends_on):
+                logger.warning(f"Invalid dependencies for plan item {i}: {item['depends_on']}. Running sequentially.")
+                return None
+            dependencies.append(depends_on)
+
+        layers, placed = [], set()
+        while len(placed) < len(plan):
+            layer = [i for i in range(len(plan)) if i not in placed and dependencies[i] <= placed]
+            if not layer:
+                logger.warning("Circular dependencies in the plan. Running sequentially.")
+                return None
+            layers.append(layer)
+            placed.update(layer)
+        return layers
+
+    async def execute_item(self, instructions_text: str, tool_name: str, goal_template: str) -> str:
         """
         Executes a single item in the plan using a tool and based on the instructions.
 
@@ -87,48 +190,52 @@ class PlanExecutor:
             The result of the item execution.
         """
         tool = self.tool_registry[tool_name]
-        return tool.run(instructions_text, goal_template)
+        return await tool.run(instructions_text, goal_template)
 
     @generative_execution
-    def reflect(self, completed: str) -> tuple:
+    async def reflect(self, completed: str, done: Optional[list] = None, todo: Optional[list] = None) -> tuple:
         """
         Reflects on the execution of the plan after each item is completed.
 
         Args:
             completed: The result of the latest completed item.
+            done: The items executed before it; defaults to the current state.
+            todo: The items still to execute; defaults to the current state.
 
         Returns:
             A tuple with the acceptance of the reflection and the feedback.
         """
         logger.info(f"Reflecting on the execution.")
+        done = self.done if done is None else done
+        recent = done[-self.REFLECT_HISTORY:]
         prompt = (
-            f"Reflect on the following plan that is being executed:\n"
-            f"-Past executed items with their results:\n{json.dumps(self.done)}\n\n"
+            f"-Past executed items with their results ({len(done) - len(recent)} earlier items omitted):\n"
+            f"{dumps(recent)}\n\n"
             f"-Latest item executed:\n{completed}\n\n"
-            f"-Remaining items to execute:\n{json.dumps(self.todo)}\n\n"
-        )
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are a system that generates judgements using a JSON template."
-                                              "Your response should follow this format:\n"
-                                              "{'acceptance': true/false, 'reflection': '<reflection here>'}"
-                                              "You only respond with JSON."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt}
-                ]}
-            ],
-            response_format={"type": "json_object"}
+            f"-Remaining items to execute:\n{dumps(self.todo if todo is None else todo)}\n\n"
         )
+        messages = build_messages(REFLECT_SYSTEM_MESSAGE, prompt)
+        # the same execution state gets the same judgement
+        cache_key = exact_cache.key(self.model, messages, temperature=0.0)
+        content = exact_cache.get(cache_key)
+        if content is None:
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.0,
+                response_format={"type": "json_object"}
+            )
+            content = response.choices[0].message.content
 
         # Extract the response from the assistant
         try:
-            jsn = json.loads(clean_markdown_response(response.choices[0].message.content))
-        except json.JSONDecodeError:
-            logger.error(f"Failed to decode JSON response from {self.model}. Response: {response}")
-            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {response}")
+            jsn = loads(clean_markdown_response(content))
+        except (orjson.JSONDecodeError, TypeError):
+            logger.error(f"Failed to decode JSON response from {self.model}. Response: {content}")
+            raise ValueError(f"Failed to decode JSON response from {self.model}. Response: {content}")
         acceptance = jsn["acceptance"]
         reflection = jsn["reflection"]
+        exact_cache.put(cache_key, content)
 
         return acceptance, reflection
 
@@ -139,3 +246,4 @@ class PlanExecutor:
         self.todo = []
         self.focus = None
         self.done = []
+        self._reflections = []
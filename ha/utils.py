@@ -1,18 +1,229 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import random
 import re
+import threading
+import time
+from collections import deque
 
+import orjson
+
+from ha import config
+
+logger = logging.getLogger(__name__)
+
+# attempts of a generative call, and the base and cap (in seconds) of the backoff between them
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 8.0
+
+# markdown code fences, with or without a language tag
+MARKDOWN_FENCE = re.compile(r'```[a-z0-9]*', re.IGNORECASE)
+
+# Receives the action log entries that no longer fit in memory; the file handler is only attached once needed
+action_logger = logging.getLogger('ha.action_log')
+action_logger.setLevel(logging.INFO)
+action_logger.propagate = False
+
+
+def _transient_errors() -> tuple:
+    # the API errors worth waiting out; only looked up once a call failed, by which time openai is loaded
+    import openai
+    return openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError
+
+
+def _backoff(attempt: int) -> float:
+    # exponential with full jitter, so that concurrent steps that were rate limited together do not retry together
+    return random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** attempt))
+
+
+def generative_execution(func=None, *, speculative: int = 1):
+    """
+    Retries a generative call and returns an error dictionary if it keeps failing. An unparseable response
+    (ValueError) is retried once, right away; rate limits, timeouts and connection errors that outlasted the SDK's own
+    retries are retried up to RETRY_ATTEMPTS in total, with an exponential backoff.
+
+    Args:
+        func: The function to wrap.
+        speculative: For async functions, the number of attempts to start at once instead of one after the other;
+            the first one to succeed wins and the others are cancelled. Trades tokens for latency.
+    """
+    if func is None:
+        return lambda f: generative_execution(f, speculative=speculative)
+
+    if inspect.iscoroutinefunction(func) and speculative > 1:
+        async def speculative_wrapper(*args, **kwargs):
+            tasks = [asyncio.ensure_future(func(*args, **kwargs)) for _ in range(speculative)]
+            error = None
+            try:
+                for attempt in asyncio.as_completed(tasks):
+                    try:
+                        return await attempt
+                    except ValueError as e:
+                        error = e
+                    except _transient_errors() as e:
+                        error = e
+            finally:
+                for task in tasks:
+                    task.cancel()
+            logger.warning(f"{func.__qualname__} failed: {error}")
+            return {"error": str(error)}
+        return speculative_wrapper
+
+    if inspect.iscoroutinefunction(func):
+        async def async_wrapper(*args, **kwargs):
+            error = None
+            for attempt in range(RETRY_ATTEMPTS):
+                try:
+                    return await func(*args, **kwargs)
+                except ValueError as e:
+                    # an unparseable response is only worth one more try
+                    retry, delay, error = not isinstance(error, ValueError), 0, e
+                except _transient_errors() as e:
+                    retry, delay, error = True, _backoff(attempt), e
+                if not retry or attempt == RETRY_ATTEMPTS - 1:
+                    break
+                logger.warning(f"{func.__qualname__} failed, retrying: {error}")
+                await asyncio.sleep(delay)
+            logger.warning(f"{func.__qualname__} failed: {error}")
+            return {"error": str(error)}
+        return async_wrapper
 
-def generative_execution(func):
     def wrapper(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except ValueError as e:
+        error = None
+        for attempt in range(RETRY_ATTEMPTS):
             try:
                 return func(*args, **kwargs)
             except ValueError as e:
-                return {"error": str(e)}
+                retry, delay, error = not isinstance(error, ValueError), 0, e
+            except _transient_errors() as e:
+                retry, delay, error = True, _backoff(attempt), e
+            if not retry or attempt == RETRY_ATTEMPTS - 1:
+                break
+            logger.warning(f"{func.__qualname__} failed, retrying: {error}")
+            time.sleep(delay)
+        logger.warning(f"{func.__qualname__} failed: {error}")
+        return {"error": str(error)}
     return wrapper
 
 
+def _default(obj):
+    # tuples (e.g. neo4j records), sets and deques are not serialised by orjson out of the box
+    if isinstance(obj, (tuple, set, frozenset, deque)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> str:
+    """
+    Serialises an object to a JSON string using orjson.
+
+    Args:
+        obj: The object to serialise.
+
+    Returns:
+        The compact JSON string.
+    """
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+loads = orjson.loads
+
+
+class ActionLog(deque):
+    """
+    A bounded action log. Once full, the oldest entries are written to the action log file instead of being kept
+    in memory.
+    """
+
+    def __init__(self, iterable=(), maxlen: int = config.MAX_ACTION_LOG):
+        super().__init__(iterable, maxlen)
+
+    def append(self, entry: dict):
+        if len(self) == self.maxlen:
+            if not action_logger.handlers:
+                os.makedirs(os.path.dirname(config.ACTION_LOG_PATH), exist_ok=True)
+                handler = logging.FileHandler(config.ACTION_LOG_PATH)
+                handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+                action_logger.addHandler(handler)
+            action_logger.info(json.dumps(self[0], default=str))
+        super().append(entry)
+
+
+class LazyObject:
+    """
+    A stand-in for an object that is only built on first use, such as a client that needs credentials or opens
+    connections. Attribute access is forwarded to the object.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self._obj = self._factory()
+        return self._obj
+
+    @property
+    def built(self) -> bool:
+        """
+        Whether the object has been built yet.
+        """
+        return self._obj is not None
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+def build_messages(system_message: dict, prompt: str) -> list:
+    """
+    Builds the messages of a chat completion request in the one shape used across the agent: a pre-built system
+    message followed by the user prompt as a bare string.
+
+    Args:
+        system_message: The system message; pass a shared module-level dict so every request starts the same way.
+        prompt: The user prompt.
+
+    Returns:
+        The list of messages.
+    """
+    return [system_message, {"role": "user", "content": prompt}]
+
+
+def json_schema_format(name: str, properties: dict) -> dict:
+    """
+    Builds a strict structured output response format, so that the model can only respond with an object of
+    exactly the given properties.
+
+    Args:
+        name: The name of the schema.
+        properties: The JSON schemas of the properties; all of them are required.
+
+    Returns:
+        The response_format of a chat completion request.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
 def clean_markdown_response(text: str) -> str:
     """
     Clean the markdown response from OpenAI.
@@ -29,9 +240,10 @@ def clean_markdown_response(text: str) -> str:
     elif type(text) is not str:
         return text
 
-    # Remove markdown
-    text = re.sub(r'```[a-z0-9]*', '', text)
-    return text
+    # Remove markdown; most structured responses have none
+    if '```' not in text:
+        return text
+    return MARKDOWN_FENCE.sub('', text)
 
 
 def green(text: str) -> str:
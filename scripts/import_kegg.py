@@ -1,158 +1,402 @@
-import xml.etree.ElementTree as ET
-from neo4j import GraphDatabase
+import asyncio
+from lxml import etree
+from neo4j import AsyncGraphDatabase
 import logging
 import os
 import argparse
+import csv
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# rows per UNWIND transaction
+BATCH_SIZE = 20_000
+# times apoc.periodic.iterate retries a failed batch, e.g. one that lost a deadlock, before giving up on it
+ITERATE_RETRIES = 3
+# transactions in flight at the same time, each on its own session
+CONCURRENCY = 16
+# relationship types are built from the relation subtypes, e.g. "binding/association" -> binding_or_association
+_RELATION_TRANSLATION = str.maketrans({' ': '_'})
+# gene names are listed as "INSR, CD220, HHF5..."; the commas and dots are dropped in one pass before splitting
+_GENE_NAMES_TRANSLATION = str.maketrans('', '', ',.')
+
+
+@lru_cache(maxsize=256)
+def _escape_relation(relation):
+    # the subtype vocabulary is small, so the escaping is done once per subtype
+    return relation.replace('/', '_or_').translate(_RELATION_TRANSLATION)
+
+
 class KEGGImporter:
 
     def __init__(self, uri, user, password):
         try:
-            self.driver = GraphDatabase.driver(uri, auth=(user, password))
+            self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password))
             logger.info("Successfully connected to Neo4j.")
         except Exception as e:
             logger.error(f"Failed to connect to Neo4j: {e}")
             raise
 
-    def close(self):
+    async def close(self):
         try:
-            self.driver.close()
+            await self.driver.close()
             logger.info("Neo4j connection closed.")
         except Exception as e:
             logger.error(f"Failed to close Neo4j connection: {e}")
 
-    def import_kegg_xml(self, xml_files):
-        with self.driver.session() as session:
-            for xml_file in xml_files:
-                try:
-                    logger.info(f"Importing {xml_file}...")
-                    tree = ET.parse(xml_file)
-                    root = tree.getroot()
-
-                    # start a id to name mapping
-                    id_to_name = {}
-
-                    # Extract pathway IDs and titles associated with the entry
-                    pathway_ids = []
-                    pathway_titles = []
-                    pathway_id = root.get('name')
-                    pathway_title = root.get('title')
-                    if pathway_id and pathway_title:
-                        pathway_ids.append(pathway_id)
-                        pathway_titles.append(pathway_title)
-
-                    for entry in root.findall('entry'):
-                        try:
-                            entry_id = entry.get('id')
-                            kegg_name = entry.get('name')
-                            entry_type = entry.get('type')  # Extract the type attribute
-                            node_label = entry_type if entry_type else 'Entry'  # Use type as node label or default to 'Entry'
-
-                            # Process graphics name into gene_names list
-                            graphics = entry.find('graphics')
-                            if graphics is not None and 'name' in graphics.attrib and isinstance(graphics.get('name'), str):
-                                gene_names = graphics.get('name').replace(',', '').replace('.', '').split(' ')
-                                entry_name = gene_names[0] if gene_names else kegg_name
-                            else:
-                                gene_names = []
-                                entry_name = kegg_name
-
-                            # add the name to id mapping
-                            if entry_name:
-                                id_to_name[entry_id] = entry_name
-
-                            # Create or update entry node with pathway IDs, titles, and type
-                            session.write_transaction(self._create_or_update_entry_node, entry_name,
-                                                      kegg_name, gene_names, pathway_ids, pathway_titles, node_label)
-
-                        except Exception as e:
-                            logger.error(f"Failed to process entry in {xml_file}: {e}")
-
-                    # Process relations after all entries are created
-                    for relation in root.findall('relation'):
-                        try:
-                            entry1 = id_to_name[relation.get('entry1')]
-                            entry2 = id_to_name[relation.get('entry2')]
-                            relation_type = relation.get('type')
-                            # set the subtype to be the same as the supertype by default
-                            relation_subtype = relation_type
-                            # find the name of the subtype element in the relation
-                            if relation.find('subtype') is not None:
-                                relation_subtype = relation.find('subtype').get('name')
-
-                            # Create or update relationship between entries
-                            session.write_transaction(self._create_relation, entry1, entry2, relation_type,
-                                                      relation_subtype)
-                        except Exception as e:
-                            logger.error(f"Failed to process relation in {xml_file}: {entry1} {entry2} {relation_type} {e} exception type {type(e)}")
-                            logger.error(f"Failed to process relation in {xml_file}: {e}")
-
-                    # Run the post-processing step to remove duplicate gene names
-                    try:
-                        session.write_transaction(self._remove_duplicate_gene_names)
-                        logger.info(f"Post-processing to remove duplicate gene names completed for {xml_file}.")
-                    except Exception as e:
-                        logger.error(f"Failed to remove duplicate gene names in {xml_file}: {e}")
+    async def create_indexes(self):
+        """
+        Create the indexes used by the import and by the agent's queries; every entry carries the Node label.
+        """
+        async with self.driver.session() as session:
+            await session.run("CREATE INDEX node_name_idx IF NOT EXISTS FOR (n:Node) ON (n.name)")
+            await session.run("CREATE INDEX node_entry_name_idx IF NOT EXISTS FOR (n:Node) ON (n.entry_name)")
 
-                except ET.ParseError as e:
-                    logger.error(f"Failed to parse XML file {xml_file}: {e}")
+    async def create_constraints(self, labels):
+        """
+        Make entry_name unique per entry label; the entry MERGEs match on it and are backed by the constraint's index.
+
+        Args:
+            labels: The entry labels, e.g. gene or compound.
+        """
+        async with self.driver.session() as session:
+            for label in labels:
+                await session.run(f"CREATE CONSTRAINT {label}_entry_name_unique IF NOT EXISTS "
+                                  f"FOR (e:{label}) REQUIRE e.entry_name IS UNIQUE")
+
+    async def create_schema(self):
+        """
+        Create the indexes and the per-label constraints of a graph that was imported without them, e.g. with
+        bulk_import; the entry labels are read from the graph.
+        """
+        async with self.driver.session() as session:
+            result = await session.run("MATCH (n:Node) UNWIND labels(n) AS label WITH DISTINCT label "
+                                       "WHERE label <> 'Node' RETURN label")
+            labels = [record['label'] async for record in result]
+        await self.create_indexes()
+        await self.create_constraints(labels)
+        logger.info(f"Created the indexes and the constraints of {len(labels)} entry labels.")
+
+    async def import_kegg_xml(self, xml_files):
+        # parse every file first so that the writes can be batched across files; relations refer to entries by name,
+        # so all the entries are written before the first relation
+        entries, relations = self._parse_kegg_xml_files(xml_files)
+
+        entries_by_label = self._group_by(entries, 'label')
+        await self.create_constraints(entries_by_label)
+
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        periodic_iterate = await self.supports_periodic_iterate()
+
+        async def write(statement, key, rows, kind, per_batch=False):
+            # the batches of a group run one after the other: concurrent MERGEs on the same entry_name could both
+            # create the node
+            async with semaphore:
+                try:
+                    async with self.driver.session() as session:
+                        if periodic_iterate and len(rows) > BATCH_SIZE:
+                            # sent once and committed batch by batch on the server, so that no single transaction
+                            # has to hold the whole group
+                            try:
+                                await self._iterate(session, statement(key), rows)
+                                return
+                            except RuntimeError as e:
+                                # the statements MERGE, so writing the whole group again from the client is safe
+                                logger.warning(f"Writing {len(rows)} {key} {kind} from the client instead: {e}")
+                        # retried on transient errors such as deadlocks; either one transaction for the group, or
+                        # one per batch so that a retry only repeats that batch
+                        for batch in (self._batches(rows) if per_batch else (rows,)):
+                            await session.execute_write(self._write_batches, statement(key), batch)
                 except Exception as e:
-                    logger.error(f"Unexpected error during import of {xml_file}: {e}")
+                    logger.error(f"Failed to import {len(rows)} {key} {kind}: {e}")
+
+        # a label or a relationship type cannot be a parameter, so there is one query per label and per type; the
+        # entries of different labels are different nodes, so their groups are written concurrently
+        await asyncio.gather(*(write(self._entries_statement, label, rows, 'entries')
+                               for label, rows in entries_by_label.items()))
+        logger.info(f"Imported {len(entries)} entries.")
+
+        # relations are grouped by their endpoint labels too, so that each endpoint is matched through the unique
+        # entry_name of its label. Creating a relationship locks both of its endpoints, and groups of different types
+        # share endpoints (e.g. activation and phosphorylation between the same genes), so concurrent groups would
+        # deadlock on each other: the groups are written one after the other, committed batch by batch
+        for key, rows in self._group_by(relations, 'type', 'label1', 'label2').items():
+            await write(self._relations_statement, key, rows, 'relations', per_batch=True)
+        logger.info(f"Imported {len(relations)} relations.")
 
     @staticmethod
-    def _create_or_update_entry_node(tx, entry_name, kegg_name, gene_names, pathway_ids, pathway_titles, node_label):
-        try:
-            query = f"""
-                MERGE (e:{node_label} {{entry_name: $entry_name}})
-                ON CREATE SET e.name = $entry_name, 
-                              e.gene_names = $gene_names,
-                              e.pathway_ids = $pathway_ids, 
-                              e.pathway_titles = $pathway_titles
-                ON MATCH SET e.gene_names = apoc.coll.toSet(e.gene_names + $gene_names),
-                              e.pathway_ids = apoc.coll.toSet(e.pathway_ids + $pathway_ids), 
-                              e.pathway_titles = apoc.coll.toSet(e.pathway_titles + $pathway_titles)
-            """
-            tx.run(query, kegg_name=kegg_name, entry_name=entry_name, gene_names=gene_names,
-                   pathway_ids=pathway_ids, pathway_titles=pathway_titles)
-        except Exception as e:
-            logger.error(f"Failed to create or update {node_label} node: {e}")
-            raise
+    def export_to_csv(xml_files, output_dir):
+        """
+        Write KEGG XML files as the CSV files of an offline neo4j-admin import. The import produces the same graph as
+        import_kegg_xml, so entries seen in several files are merged here, with their names and pathways unioned.
+
+        Args:
+            xml_files: The paths to the KEGG XML files.
+            output_dir: The directory to write the CSV files to.
+
+        Returns:
+            A tuple of the paths to the node files, one per entry label, and the path to the relationship file.
+        """
+        entries, relations = KEGGImporter._parse_kegg_xml_files(xml_files)
+        os.makedirs(output_dir, exist_ok=True)
+
+        # entries of different labels may share a name, so the node ids are the label and the name
+        nodes = {}
+        for entry in entries:
+            node_id = f"{entry['label']}:{entry['entry_name']}"
+            node = nodes.get(node_id)
+            if node is None:
+                nodes[node_id] = dict(entry)
+            else:
+                for key in ('gene_names', 'pathway_ids', 'pathway_titles'):
+                    node[key] = list(dict.fromkeys(node[key] + entry[key]))
+
+        node_files = []
+        for label, rows in KEGGImporter._group_by(list(nodes.values()), 'label').items():
+            path = os.path.join(output_dir, f"nodes_{label}.csv")
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow([':ID(Entry)', 'entry_name', 'name', 'gene_names:string[]', 'pathway_ids:string[]',
+                                 'pathway_titles:string[]', ':LABEL'])
+                for row in rows:
+                    writer.writerow([f"{label}:{row['entry_name']}", row['entry_name'], row['entry_name'],
+                                     ';'.join(row['gene_names']), ';'.join(row['pathway_ids']),
+                                     ';'.join(row['pathway_titles']), f"Node;{label}"])
+            node_files.append(path)
+
+        # like the MERGE of the online import, a relation is written once per type, with the supertype it was last
+        # seen with
+        edges = {}
+        for relation in relations:
+            start = f"{relation['label1']}:{relation['entry1']}"
+            end = f"{relation['label2']}:{relation['entry2']}"
+            edges[start, end, relation['type']] = relation['relation_type']
+
+        relationship_file = os.path.join(output_dir, "relationships.csv")
+        with open(relationship_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([':START_ID(Entry)', ':END_ID(Entry)', ':TYPE', 'supertype'])
+            for (start, end, relation_type), supertype in edges.items():
+                writer.writerow([start, end, relation_type, supertype])
+
+        logger.info(f"Exported {len(nodes)} entries and {len(edges)} relations to {output_dir}.")
+        return node_files, relationship_file
+
+    @staticmethod
+    def bulk_import(xml_files, output_dir, database='neo4j', neo4j_admin='neo4j-admin'):
+        """
+        Import KEGG XML files with neo4j-admin, which is much faster than import_kegg_xml for a full load. The
+        database must not exist yet and the import runs on the Neo4j host, with the server stopped; create the indexes
+        and constraints with create_schema (--schema-only) once the server is back up.
+
+        Args:
+            xml_files: The paths to the KEGG XML files.
+            output_dir: The directory to write the intermediate CSV files to.
+            database: The name of the database to create.
+            neo4j_admin: The neo4j-admin executable.
+
+        Raises:
+            subprocess.CalledProcessError: If neo4j-admin fails.
+        """
+        node_files, relationship_file = KEGGImporter.export_to_csv(xml_files, output_dir)
+        # the neo4j-admin 4.4 syntax, matching the server version the Makefile runs
+        command = [neo4j_admin, 'import', f"--database={database}", *(f"--nodes={path}" for path in node_files),
+                   f"--relationships={relationship_file}", "--array-delimiter=;"]
+        logger.info(f"Running {' '.join(command)}")
+        subprocess.run(command, check=True)
+
+    @staticmethod
+    def _parse_kegg_xml_files(xml_files):
+        entries, relations = [], []
+        # parsing is CPU-bound, so the files are spread over worker processes; a single file is parsed in place
+        if len(xml_files) > 1:
+            with ProcessPoolExecutor() as pool:
+                parsed = list(pool.map(KEGGImporter._parse_kegg_xml, xml_files))
+        else:
+            parsed = [KEGGImporter._parse_kegg_xml(xml_file) for xml_file in xml_files]
+        for file_entries, file_relations in parsed:
+            entries.extend(file_entries)
+            relations.extend(file_relations)
+        return entries, relations
 
     @staticmethod
-    def _create_relation(tx, entry1, entry2, relation_type, relation_subtype):
-        def escape_relation(relation):
-            return relation.replace(' ', '_').replace('/', '_or_')
+    def _parse_kegg_xml(xml_file):
+        """
+        Parse a KEGG XML file into the rows written by the import.
+
+        Args:
+            xml_file: The path to the KEGG XML file.
+
+        Returns:
+            A tuple of the entry rows and the relation rows; both are empty if the file cannot be parsed.
+        """
+        entries, relations = [], []
         try:
-            # Dynamically construct the relationship type part of the query
-            query = f"""
-                MATCH (e1 {{name: $entry1}})
-                WITH e1
-                MATCH (e2 {{name: $entry2}})
-                MERGE (e1)-[r:{escape_relation(relation_subtype)}]->(e2)
-                SET r.supertype = $relation_type
-            """
-            tx.run(query, entry1=entry1, entry2=entry2, relation_type=relation_type)
+            logger.info(f"Parsing {xml_file}...")
+
+            # the label and name of every entry id; entry ids are only unique within a file
+            id_to_entry = {}
+            # the rows of the entries read so far, by label and name; entries repeated within a file share one row
+            rows_by_name = {}
+            # relations refer to entries by id, so they are resolved once the whole file has been read
+            pending_relations = []
+
+            # Extract pathway IDs and titles associated with the entry
+            pathway_ids = []
+            pathway_titles = []
+
+            # the file is streamed; every entry and relation is released as soon as it has been read
+            for event, elem in etree.iterparse(xml_file, events=('start', 'end'),
+                                               tag=('pathway', 'entry', 'relation')):
+                if elem.tag == 'pathway':
+                    if event == 'start':
+                        pathway_id = elem.get('name')
+                        pathway_title = elem.get('title')
+                        if pathway_id and pathway_title:
+                            pathway_ids.append(pathway_id)
+                            pathway_titles.append(pathway_title)
+                    continue
+                if event == 'start':
+                    continue
+
+                if elem.tag == 'entry':
+                    try:
+                        entry_id = elem.get('id')
+                        kegg_name = elem.get('name')
+                        entry_type = elem.get('type')  # Extract the type attribute
+                        node_label = entry_type if entry_type else 'Entry'  # Use type as node label or default to 'Entry'
+
+                        # Process graphics name into gene_names list
+                        graphics = elem.find('graphics')
+                        if graphics is not None and isinstance(graphics.get('name'), str):
+                            gene_names = graphics.get('name').translate(_GENE_NAMES_TRANSLATION).split(' ')
+                            entry_name = gene_names[0] if gene_names else kegg_name
+                        else:
+                            gene_names = []
+                            entry_name = kegg_name
+
+                        if entry_name:
+                            id_to_entry[entry_id] = (node_label, entry_name)
+
+                        row = rows_by_name.get((node_label, entry_name))
+                        if row is None:
+                            rows_by_name[node_label, entry_name] = {
+                                "entry_name": entry_name, "kegg_name": kegg_name, "gene_names": gene_names,
+                                "pathway_ids": pathway_ids, "pathway_titles": pathway_titles, "label": node_label}
+                        else:
+                            row["gene_names"] = list(dict.fromkeys(row["gene_names"] + gene_names))
+
+                    except Exception as e:
+                        logger.error(f"Failed to process entry in {xml_file}: {e}")
+                else:
+                    relation_type = elem.get('type')
+                    # set the subtype to be the same as the supertype by default
+                    relation_subtype = relation_type
+                    # find the name of the subtype element in the relation
+                    subtype = elem.find('subtype')
+                    if subtype is not None:
+                        relation_subtype = subtype.get('name')
+                    pending_relations.append((elem.get('entry1'), elem.get('entry2'), relation_type, relation_subtype))
+
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+            for entry1_id, entry2_id, relation_type, relation_subtype in pending_relations:
+                entry1, entry2 = id_to_entry.get(entry1_id), id_to_entry.get(entry2_id)
+                if entry1 is None or entry2 is None:
+                    logger.error(f"Failed to process relation in {xml_file}: unknown entry {entry1_id} or {entry2_id}")
+                    continue
+                relations.append({"label1": entry1[0], "entry1": entry1[1], "label2": entry2[0], "entry2": entry2[1],
+                                  "relation_type": relation_type, "type": _escape_relation(relation_subtype)})
+            entries = list(rows_by_name.values())
+
+        except etree.XMLSyntaxError as e:
+            logger.error(f"Failed to parse XML file {xml_file}: {e}")
         except Exception as e:
-            logger.error(f"Failed to create relation of type {relation_type} with subtype {relation_subtype}: {e}")
-            raise
+            logger.error(f"Unexpected error during import of {xml_file}: {e}")
+        return entries, relations
 
-    @staticmethod
-    def _remove_duplicate_gene_names(tx):
+    async def supports_periodic_iterate(self):
+        """
+        Check whether the server has apoc.periodic.iterate, which large groups are written with.
+
+        Returns:
+            True if the procedure is available.
+        """
         try:
-            tx.run("""
-                MATCH (e)
-                WITH e, apoc.coll.toSet(e.gene_names) AS unique_gene_names
-                SET e.gene_names = unique_gene_names
-            """)
+            async with self.driver.session() as session:
+                result = await session.run("SHOW PROCEDURES YIELD name WHERE name = 'apoc.periodic.iterate' "
+                                           "RETURN count(*) AS available")
+                record = await result.single()
+                return bool(record['available'])
         except Exception as e:
-            logger.error(f"Failed to remove duplicate gene names: {e}")
-            raise
+            logger.warning(f"Could not look up apoc.periodic.iterate, writing from the client: {e}")
+            return False
+
+    @staticmethod
+    async def _write_batches(tx, statement, rows):
+        for batch in KEGGImporter._batches(rows):
+            await tx.run(f"UNWIND $rows AS r {statement}", rows=batch)
+
+    @staticmethod
+    async def _iterate(session, statement, rows):
+        # the batches are not run in parallel, for the same reason the batches of a group are written in order
+        result = await session.run(
+            "CALL apoc.periodic.iterate('UNWIND $rows AS r RETURN r', $statement, "
+            "{batchSize: $batch_size, parallel: false, retries: $retries, params: {rows: $rows}}) "
+            "YIELD failedBatches, errorMessages",
+            statement=statement, rows=rows, batch_size=BATCH_SIZE, retries=ITERATE_RETRIES)
+        record = await result.single()
+        if record['failedBatches']:
+            raise RuntimeError(f"{record['failedBatches']} batches failed: {record['errorMessages']}")
 
-    def test_import(self):
+    @staticmethod
+    def _group_by(rows, *keys):
+        # grouped by the value of a single key, or by the tuple of values of several keys
+        groups = {}
+        for row in rows:
+            group = tuple(row[key] for key in keys) if len(keys) > 1 else row[keys[0]]
+            groups.setdefault(group, []).append(row)
+        return groups
+
+    @staticmethod
+    def _batches(rows, size=BATCH_SIZE):
+        for i in range(0, len(rows), size):
+            yield rows[i:i + size]
+
+    @staticmethod
+    def _entries_statement(node_label):
+        # the statement for a row r; gene names are de-duplicated as they are written, so no clean-up pass is needed
+        # after the import
+        return f"""
+            MERGE (e:Node:{node_label} {{entry_name: r.entry_name}})
+            ON CREATE SET e.name = r.entry_name,
+                          e.gene_names = apoc.coll.toSet(r.gene_names),
+                          e.pathway_ids = r.pathway_ids,
+                          e.pathway_titles = r.pathway_titles
+            ON MATCH SET e.gene_names = apoc.coll.toSet(e.gene_names + r.gene_names),
+                          e.pathway_ids = apoc.coll.toSet(e.pathway_ids + r.pathway_ids),
+                          e.pathway_titles = apoc.coll.toSet(e.pathway_titles + r.pathway_titles)
+        """
+
+    @staticmethod
+    def _relations_statement(key):
+        # the statement for a row r; the relationship type is escaped when the rows are built
+        relation_type, label1, label2 = key
+        return f"""
+            MATCH (e1:{label1} {{entry_name: r.entry1}})
+            WITH e1, r
+            MATCH (e2:{label2} {{entry_name: r.entry2}})
+            MERGE (e1)-[x:{relation_type}]->(e2)
+            SET x.supertype = r.relation_type
+        """
+
+    async def test_import(self):
         """
         Run a test query to check if the import was successful. This test checks if the INSR node has at least 2
         pathway titles.
@@ -160,13 +404,13 @@ class KEGGImporter:
         Raises:
             ValueError: If the INSR node is not found or does not have at least 2 pathway titles.
         """
-        with self.driver.session() as session:
+        async with self.driver.session() as session:
 
             logger.info("Running import tests...")
 
             # test 1: check if the INSR node has at least 2 pathway titles
-            result = session.run('MATCH (n {name: "INSR"}) RETURN n.pathway_titles AS pathway_titles')
-            record = result.single()
+            result = await session.run('MATCH (n {name: "INSR"}) RETURN n.pathway_titles AS pathway_titles')
+            record = await result.single()
 
             assert record is not None, "INSR node not found in the database."
 
@@ -176,8 +420,8 @@ class KEGGImporter:
             assert count > 1, f"Expected at least 2 pathway titles for INSR, but found {count}. Pathway titles: {pathway_titles}"
 
             # test 2: check if the INSR has a subtree larger than 1
-            result = session.run('MATCH (n {name: "INSR"})-[*]->(m) RETURN count(distinct m) AS subtree_size')
-            record = result.single()
+            result = await session.run('MATCH (n {name: "INSR"})-[*]->(m) RETURN count(distinct m) AS subtree_size')
+            record = await result.single()
 
             assert record is not None, "INSR node does not have any descendants."
 
@@ -203,11 +447,17 @@ if __name__ == "__main__":
                         help='Neo4j password (default from environment variable NEO4J_PASSWORD)')
     parser.add_argument('-f', '--file', type=str, help='Path to a single KEGG XML file to import')
     parser.add_argument('-d', '--directory', type=str, help='Directory containing multiple KEGG XML files to import')
+    parser.add_argument('-b', '--bulk', type=str, metavar='CSV_DIR',
+                        help='Import offline with neo4j-admin, writing the intermediate CSV files to CSV_DIR; '
+                             'the Neo4j server must be stopped and the database must not exist')
+    parser.add_argument('--database', type=str, default='neo4j', help='Database to create with --bulk (default neo4j)')
+    parser.add_argument('--schema-only', action='store_true',
+                        help='Only create the indexes and constraints on the running server, e.g. after --bulk')
 
     args = parser.parse_args()
 
     # Ensure at least one input method is provided
-    if not args.file and not args.directory:
+    if not args.file and not args.directory and not args.schema_only:
         parser.error('No input source specified. Please provide either a file or a directory.')
 
     # Collect the files to process
@@ -219,16 +469,32 @@ if __name__ == "__main__":
             if file_name.endswith('.xml'):
                 kegg_xml_files.append(os.path.join(args.directory, file_name))
 
-    # Initialize the importer and process the files
-    importer = None
-    try:
-        importer = KEGGImporter(args.uri, args.user, args.password)
-        importer.import_kegg_xml(kegg_xml_files)
-        importer.test_import()
-    except ValueError as e:
-        logger.error(f"An error occurred during the import process: {e}")
-    except Exception as e:
-        logger.error(f"An error occurred during the import process: {e}")
-    finally:
-        if importer:
-            importer.close()
+    if args.bulk:
+        try:
+            KEGGImporter.bulk_import(kegg_xml_files, args.bulk, args.database)
+            logger.info("Bulk import completed; start the server and run this script with --schema-only to create the "
+                        "indexes and constraints.")
+        except Exception as e:
+            logger.error(f"An error occurred during the bulk import: {e}")
+
+    async def main():
+        # Initialize the importer and process the files
+        importer = None
+        try:
+            importer = KEGGImporter(args.uri, args.user, args.password)
+            if args.schema_only:
+                await importer.create_schema()
+                return
+            await importer.create_indexes()
+            await importer.import_kegg_xml(kegg_xml_files)
+            await importer.test_import()
+        except ValueError as e:
+            logger.error(f"An error occurred during the import process: {e}")
+        except Exception as e:
+            logger.error(f"An error occurred during the import process: {e}")
+        finally:
+            if importer:
+                await importer.close()
+
+    if not args.bulk:
+        asyncio.run(main())
@@ -1,4 +1,7 @@
-import json
+import os
+import socket
+from functools import lru_cache
+
 import pytest
 
 from ha.tools.gaf import Gaf
@@ -6,50 +9,154 @@ from ha.tools.graph import GraphAnalysis
 from ha.tools.instructor import Instructor
 from ha.tools.kegg import Kegg
 from ha.tools.plan import PlanExecutor
+from ha.agent.exact_cache import ExactCache
 from ha.agent.planner import Planner
+from ha.models import async_openai_client as client
 from ha.neo4j import graphdb as driver
+from ha.utils import loads
 
 
-@pytest.fixture
+# LLM responses recorded by the recorded_llm fixture. No recordings are committed yet, so the tests that use it still
+# call the API on their first run and keep @flaky for it; the responses of a passing run are recorded (make
+# record-llm), and once the file is committed those tests replay them and @flaky can be dropped from them.
+LLM_RECORDINGS_PATH = os.getenv('LLM_RECORDINGS_PATH',
+                                os.path.join(os.path.dirname(__file__), 'data', 'llm_recordings.sqlite'))
+
+
+def pytest_collection_modifyitems(items):
+    # under pytest-xdist the tests are spread over workers; the ones that write to the database share one worker
+    for item in items:
+        if item.get_closest_marker('serial'):
+            item.add_marker(pytest.mark.xdist_group('serial'))
+
+
+@lru_cache(maxsize=1)
+def unavailable_services() -> tuple:
+    """
+    Probes the services the integration tests need, once per test run (and per xdist worker).
+
+    Returns:
+        The descriptions of the services that cannot be reached; empty if all of them can.
+    """
+    unavailable = []
+    try:
+        driver.verify_connectivity()
+    except Exception as e:
+        unavailable.append(f"Neo4j ({e})")
+    try:
+        url = client.base_url
+        socket.create_connection((url.host, url.port or 443), timeout=5).close()
+    except Exception as e:
+        unavailable.append(f"the OpenAI API ({e})")
+    return tuple(unavailable)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    # the outcome of the test call, for fixtures that act on it at teardown
+    outcome = yield
+    report = outcome.get_result()
+    if report.when == 'call':
+        item.passed = report.passed
+
+
+def pytest_runtest_setup(item):
+    # the integration tests are skipped together instead of each one waiting for its own connection timeout
+    if item.get_closest_marker('integration') and unavailable_services():
+        pytest.skip(f"Unavailable: {', '.join(unavailable_services())}")
+
+
+@pytest.fixture(scope="session")
 def gaf():
     return Gaf()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def kegg():
     return Kegg()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session", autouse=True)
 def graphdb():
-    return driver
+    # the tools share one driver; it is closed once, after the last test, if any test opened it
+    yield driver
+    if driver.built:
+        driver.close()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def plan_executor():
     return PlanExecutor()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def planner():
     return Planner()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def tool_registry():
     return PlanExecutor.tool_registry
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def conversations():
-    with open('tests/data/conversations.json') as f:
-        return json.load(f)
+    with open('tests/data/conversations.json', 'rb') as f:
+        return loads(f.read())
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def ga():
     return GraphAnalysis()
 
-@pytest.fixture
+
+@pytest.fixture(scope="session")
 def instructor():
     return Instructor()
+
+
+@pytest.fixture(scope="session")
+def llm_recordings():
+    # recordings do not expire
+    return ExactCache(path=LLM_RECORDINGS_PATH, ttl=2 ** 31)
+
+
+def _recorded(create, recordings, response_type, new):
+    """
+    Wraps a create method of the OpenAI client so that a request is sent once and its response is replayed from
+    the recordings afterwards, whatever its temperature. The responses that were not recorded yet are collected in
+    new, to be recorded only if the test passes.
+    """
+    async def recorded_create(model, **params):
+        # the messages of a completion, or the input of an embedding, and everything else that shapes the response
+        prompt = {name: value for name, value in params.items() if name in ('messages', 'input')}
+        key = ExactCache.key(model, list(prompt.values()), **{name: value for name, value in params.items()
+                                                               if name not in prompt})
+        content = new.get(key) or recordings.get(key)
+        if content is None:
+            response = await create(model=model, **params)
+            new[key] = response.model_dump_json()
+            return response
+        return response_type.model_validate_json(content)
+    return recorded_create
+
+
+@pytest.fixture
+def recorded_llm(request, monkeypatch, llm_recordings):
+    """
+    Makes the LLM calls of a test deterministic: every completion and embedding request is answered from the
+    recordings, and only requests that were never seen reach the API. The responses of a failing test are not
+    recorded, so a @flaky rerun asks the API again instead of replaying the response that failed.
+    """
+    from openai.types import CreateEmbeddingResponse
+    from openai.types.chat import ChatCompletion
+
+    new = {}
+    completions, embeddings = client.chat.completions, client.embeddings
+    monkeypatch.setattr(completions, 'create', _recorded(completions.create, llm_recordings, ChatCompletion, new))
+    monkeypatch.setattr(embeddings, 'create',
+                        _recorded(embeddings.create, llm_recordings, CreateEmbeddingResponse, new))
+    yield llm_recordings
+    if getattr(request.node, 'passed', False):
+        for key, content in new.items():
+            llm_recordings.put(key, content)
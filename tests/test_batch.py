@@ -0,0 +1,30 @@
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from ha.agent import batch
+
+
+async def test_batch_completions_returns_contents_in_request_order():
+    output = '\n'.join([
+        json.dumps({"custom_id": "1", "response": {"status_code": 200,
+                                                   "body": {"choices": [{"message": {"content": "second"}}]}}}),
+        json.dumps({"custom_id": "0", "response": {"status_code": 200,
+                                                   "body": {"choices": [{"message": {"content": "first"}}]}}}),
+        json.dumps({"custom_id": "2", "response": {"status_code": 500, "body": {}}, "error": "server error"}),
+    ])
+    client = SimpleNamespace(
+        files=SimpleNamespace(create=AsyncMock(return_value=SimpleNamespace(id='file-in')),
+                              content=AsyncMock(return_value=SimpleNamespace(text=output))),
+        batches=SimpleNamespace(
+            create=AsyncMock(return_value=SimpleNamespace(id='batch', status='in_progress', output_file_id=None)),
+            retrieve=AsyncMock(return_value=SimpleNamespace(id='batch', status='completed', output_file_id='file-out'))
+        )
+    )
+    bodies = [{"model": "m", "messages": []} for _ in range(3)]
+    with patch.object(batch, 'client', client):
+        contents = await batch.batch_completions(bodies, poll_interval=0)
+
+    assert contents == ['first', 'second', None]
+    uploaded = client.files.create.call_args.kwargs['file'][1].decode().splitlines()
+    assert [json.loads(line)['custom_id'] for line in uploaded] == ['0', '1', '2']
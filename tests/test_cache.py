@@ -0,0 +1,53 @@
+
+import numpy as np
+import pytest
+
+from ha.agent.cache import SemanticCache
+
+
+VECTORS = {
+    'What is the INSR gene?': [1.0, 0.0, 0.0],
+    'what is the INSR gene': [0.99, 0.05, 0.0],
+    'How is the weather today?': [0.0, 1.0, 0.0],
+}
+
+
+async def fake_embed(text):
+    return np.asarray(VECTORS[text], dtype=np.float32)
+
+
+@pytest.fixture
+def cache():
+    return SemanticCache(path=':memory:', embed=fake_embed)
+
+
+async def test_semantic_cache_hit_on_similar_prompt(cache):
+    scope = SemanticCache.scope_for('test', 'model')
+    await cache.store('What is the INSR gene?', 'The insulin receptor.', scope)
+    assert await cache.lookup('what is the INSR gene', scope) == 'The insulin receptor.'
+
+
+async def test_semantic_cache_miss_on_different_prompt(cache):
+    scope = SemanticCache.scope_for('test', 'model')
+    await cache.store('What is the INSR gene?', 'The insulin receptor.', scope)
+    assert await cache.lookup('How is the weather today?', scope) is None
+
+
+async def test_semantic_cache_is_scoped(cache):
+    await cache.store('What is the INSR gene?', 'The insulin receptor.', SemanticCache.scope_for('a'))
+    assert await cache.lookup('What is the INSR gene?', SemanticCache.scope_for('b')) is None
+
+
+async def test_semantic_cache_expires(cache):
+    scope = SemanticCache.scope_for('test', 'model')
+    await cache.store('What is the INSR gene?', 'The insulin receptor.', scope)
+    assert await cache.lookup('What is the INSR gene?', scope, ttl=-1) is None
+
+
+async def test_semantic_cache_evicts_the_oldest_entries():
+    cache = SemanticCache(path=':memory:', embed=fake_embed, maxsize=1)
+    scope = SemanticCache.scope_for('test', 'model')
+    await cache.store('What is the INSR gene?', 'The insulin receptor.', scope)
+    await cache.store('How is the weather today?', 'Sunny.', scope)
+    assert await cache.lookup('What is the INSR gene?', scope) is None
+    assert await cache.lookup('How is the weather today?', scope) == 'Sunny.'
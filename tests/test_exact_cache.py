@@ -0,0 +1,29 @@
+from ha.agent.exact_cache import ExactCache
+
+
+def test_exact_cache_key_is_stable():
+    messages = [{"role": "system", "content": "a"}, {"role": "user", "content": "b"}]
+    assert ExactCache.key('model', messages, temperature=0.0) == ExactCache.key('model', list(messages), temperature=0.0)
+    assert ExactCache.key('model', messages, temperature=0.0) != ExactCache.key('other', messages, temperature=0.0)
+
+
+def test_exact_cache_evicts_least_recently_used():
+    cache = ExactCache(maxsize=2)
+    cache.put('a', '1')
+    cache.put('b', '2')
+    assert cache.get('a') == '1'
+    cache.put('c', '3')
+    assert cache.get('b') is None
+    assert cache.get('a') == '1'
+    assert cache.get('c') == '3'
+    assert len(cache) == 2
+
+
+def test_exact_cache_persists_on_disk(tmp_path):
+    path = str(tmp_path / 'exact_cache.sqlite')
+    ExactCache(path=path).put('a', '1')
+    cache = ExactCache(path=path)
+    assert cache.get('a') == '1'
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert ExactCache(path=path, ttl=-1).get('a') is None
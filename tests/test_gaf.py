@@ -1,14 +1,14 @@
 import json
 
+import httpx
 import pytest
-import requests
 from unittest.mock import patch
 
-from ha.tools.gaf import get_go_term_text
+from ha.tools.gaf import GAF_CACHE_VERSION, Gaf, get_go_term_text, get_go_term_texts
 from ha.utils import clean_markdown_response
 
 
-@patch('requests.get')
+@patch('ha.tools.gaf._CLIENT.get')
 def test_get_go_term_text_success(mock_get):
     # Mock the GET request to return a successful response with the mock data
     mock_get.return_value.json.return_value = {
@@ -26,8 +26,12 @@ def test_get_go_term_text_success(mock_get):
     # Ensure that the request was made with the correct URL
     mock_get.assert_called_once_with(f'https://www.ebi.ac.uk/QuickGO/services/ontology/go/terms/{go_id}')
 
+    # the term is shared with the batched lookups and not requested again
+    assert get_go_term_texts([go_id]) == {go_id: 'mock_GO_term_name'}
+    mock_get.assert_called_once()
 
-@patch('requests.get')
+
+@patch('ha.tools.gaf._CLIENT.get')
 def test_get_go_term_text_failure(mock_get):
     # Mock the GET request to return an empty results list (simulate failure)
     mock_get.return_value.json.return_value = {
@@ -44,26 +48,61 @@ def test_get_go_term_text_failure(mock_get):
     mock_get.assert_called_once_with(f'https://www.ebi.ac.uk/QuickGO/services/ontology/go/terms/{go_id}')
 
 
-@patch('requests.get')
+@patch('ha.tools.gaf._CLIENT.get')
 def test_get_go_term_text_http_error(mock_get):
     # Simulate an HTTP error (e.g., 404 Not Found)
-    mock_get.side_effect = requests.exceptions.HTTPError
+    mock_get.side_effect = httpx.HTTPError('Not Found')
 
     go_id = 'GO:0000000'
-    with pytest.raises(requests.exceptions.HTTPError):
+    with pytest.raises(httpx.HTTPError):
         get_go_term_text(go_id)
 
     # Ensure that the request was made with the correct URL
     mock_get.assert_called_once_with(f'https://www.ebi.ac.uk/QuickGO/services/ontology/go/terms/{go_id}')
 
 
+@patch('ha.tools.gaf._CLIENT.get')
+def test_get_go_term_texts_batches_lookups(mock_get):
+    mock_get.return_value.json.return_value = {
+        'results': [
+            {'id': 'GO:0005158', 'name': 'insulin receptor binding'},
+            {'id': 'GO:0005515', 'name': 'protein binding'}
+        ]
+    }
+
+    result = get_go_term_texts(['GO:0005158', 'GO:0005515', 'GO:0005158'])
+    assert result == {'GO:0005158': 'insulin receptor binding', 'GO:0005515': 'protein binding'}
+    mock_get.assert_called_once_with('https://www.ebi.ac.uk/QuickGO/services/ontology/go/terms/GO:0005158,GO:0005515')
+
+    # known terms are not looked up again
+    assert get_go_term_texts(['GO:0005515']) == {'GO:0005515': 'protein binding'}
+    mock_get.assert_called_once()
+
+
+def test_gaf_load_data_caches_parquet(tmp_path):
+    gaf_file = tmp_path / 'test.gaf'
+    gaf_file.write_text('!gaf-version: 2.2\n'
+                        'UniProtKB\tP35568\tIRS1\tenables\tGO:0005158\tPMID:1\tIPI\t\tF\t'
+                        'Insulin receptor substrate 1\tIRS1\tprotein\ttaxon:9606\t20240101\tUniProt\t\t\n')
+    data = Gaf.load_data(str(gaf_file))
+    assert (tmp_path / f'test.gaf.v{GAF_CACHE_VERSION}.parquet').exists()
+    assert not list(tmp_path.glob('*.tmp'))
+    assert data['Evidence'].dtype == 'category'
+    assert 'Synonym' not in data.columns
+
+    cached = Gaf.load_data(str(gaf_file))
+    assert cached['DB_Object_Symbol'].tolist() == ['IRS1']
+    assert cached['Evidence'].dtype == 'category'
+    assert cached['DB_Object_Symbol'].dtype == 'string[pyarrow]'
+
+
 @pytest.mark.integration
-def test_gaf_run_sanity(gaf):
+async def test_gaf_run_sanity(gaf):
     goal_template = ('{"query": "<query here>", '
                      '"explanation": "<explanation here>"}, '
                      '"query_result": <verbatim result here or null for no result>}')
     request = "Retrieve information about the DCC gene."
-    r = gaf.run(request, goal_template=goal_template)
+    r = await gaf.run(request, goal_template=goal_template)
     response = json.loads(clean_markdown_response(r))
     assert response['query'], 'Query is missing.'
     assert response['explanation'], 'Explanation is missing.'
@@ -81,11 +120,11 @@ def test_gaf_run_sanity(gaf):
         ('not_retrevied', 'What gene is associated with Alzheimer disease?')
     ]
 )
-def test_gaf_run_cases(gaf, expected, case):
+async def test_gaf_run_cases(gaf, expected, case):
     goal_template = ('{"query": "<query here>", '
                      '"explanation": "<explanation here>"}, '
                      '"query_result": <verbatim result here or null for no result>}')
-    r = gaf.run(case, goal_template=goal_template)
+    r = await gaf.run(case, goal_template=goal_template)
     print(r)
     response = json.loads(clean_markdown_response(r))
     if expected == 'retrieved':
@@ -14,7 +14,7 @@ def test_get_directly_impacted_nodes():
     expected_result = ['MAPK1', 'IRS1']
 
     # Call the method
-    result = GraphAnalysis.get_directly_impacted_nodes(node_name, pathway_title)
+    result = GraphAnalysis._run_analysis(node_name, pathway_title)['directly_impacted_nodes']
 
     # Assertions
     print(result)
@@ -32,15 +32,14 @@ def test_get_roots_to_node_distances():
     expected_max_distance = 3
 
     # Call the function with the test parameters
-    result = GraphAnalysis.get_roots_to_node_distances(node_name, pathway_title)
+    result = GraphAnalysis._run_analysis(node_name, pathway_title)['root_to_node']
 
     # Verify the results
-    assert result[
-               'min_distance'] == expected_min_distance, (f"Expected min distance {expected_min_distance}, "
-                                                          f"but got {result['min_distance']}")
-    assert result[
-               'max_distance'] == expected_max_distance, (f"Expected max distance {expected_max_distance}, "
-                                                          f"but got {result['max_distance']}")
+    min_distance, max_distance = result
+    assert min_distance == expected_min_distance, (f"Expected min distance {expected_min_distance}, "
+                                                   f"but got {min_distance}")
+    assert max_distance == expected_max_distance, (f"Expected max distance {expected_max_distance}, "
+                                                   f"but got {max_distance}")
 
 
 @pytest.mark.integration
@@ -54,36 +53,35 @@ def test_get_node_subtree_depths():
     expected_max_distance = 4
 
     # Call the method under test
-    result = GraphAnalysis.get_node_subtree_depths(node_name, pathway_title)
+    result = GraphAnalysis._run_analysis(node_name, pathway_title)['node_to_leaf']
 
     # Assert the results are as expected
-    assert result[
-               'min_distance'] == expected_min_distance, (f"Expected min distance {expected_min_distance}, "
-                                                          f"but got {result['min_distance']}")
-    assert result[
-               'max_distance'] == expected_max_distance, (f"Expected max distance {expected_max_distance}, "
-                                                          f"but got {result['max_distance']}")
+    min_distance, max_distance = result
+    assert min_distance == expected_min_distance, (f"Expected min distance {expected_min_distance}, "
+                                                   f"but got {min_distance}")
+    assert max_distance == expected_max_distance, (f"Expected max distance {expected_max_distance}, "
+                                                   f"but got {max_distance}")
 
 
 @pytest.mark.integration
 def test_get_root_depths():
     # Define the test input
     pathway_title = "Type II diabetes mellitus"
+    node_name = "INSR"
 
     # Expected output (these values are what you expect the test to return)
     expected_min_distance = 1
     expected_max_distance = 7
 
     # Call the method under test
-    result = GraphAnalysis.get_root_depths(pathway_title)
+    result = GraphAnalysis._run_analysis(node_name, pathway_title)['root_to_leaf']
 
     # Assert the results are as expected
-    assert result[
-               'min_distance'] == expected_min_distance, (f"Expected min distance {expected_min_distance}, "
-                                                          f"but got {result['min_distance']}")
-    assert result[
-               'max_distance'] == expected_max_distance, (f"Expected max distance {expected_max_distance}, "
-                                                          f"but got {result['max_distance']}")
+    min_distance, max_distance = result
+    assert min_distance == expected_min_distance, (f"Expected min distance {expected_min_distance}, "
+                                                   f"but got {min_distance}")
+    assert max_distance == expected_max_distance, (f"Expected max distance {expected_max_distance}, "
+                                                   f"but got {max_distance}")
 
 
 @pytest.mark.integration
@@ -99,7 +97,7 @@ def test_forest_subarea_ratio():
     threshold = 0.01
 
     # Call the method under test
-    result = GraphAnalysis.forest_subarea_ratio(node_name, pathway_title)
+    result = GraphAnalysis._run_analysis(node_name, pathway_title)['forest_subarea_ratio']
 
     # Check if the result is within the acceptable range
     assert abs(
@@ -107,9 +105,9 @@ def test_forest_subarea_ratio():
                                                 f"but got {result}")
 
 @pytest.mark.integration
-def test_graph_analysis_sanity_run(ga):
+async def test_graph_analysis_sanity_run(ga):
     instructions = "What is the impact of INSR gene on Type II diabetes mellitus pathway?"
-    response = json.loads(ga.run(instructions=instructions))
+    response = json.loads(await ga.run(instructions=instructions))
     print(response)
     assert response['node_name'] == 'INSR', "node_name is not as expected"
     assert response['pathway_title'] == 'Type II diabetes mellitus', "pathway_title is not as expected"
@@ -1,17 +1,19 @@
 from flaky import flaky
 import json
 import pytest
+from unittest.mock import MagicMock, patch
 
+from ha.tools import kegg as kegg_module
 from ha.utils import clean_markdown_response
 
 
 @pytest.mark.integration
-def test_kegg_sanity_run(kegg):
+async def test_kegg_sanity_run(kegg):
     request = "Retrieve information about the DCC gene related to Colorectal cancer."
     goal_template = ('{"query": "<query here>", '
                      '"explanation": "<explanation here>"}, '
                      '"query_result": <result here or null for no result>}')
-    r = kegg.run(request, goal_template=goal_template)
+    r = await kegg.run(request, goal_template=goal_template)
     response = json.loads(clean_markdown_response(r))
     print(response)
     assert response['query'], 'Query is missing.'
@@ -32,11 +34,11 @@ def test_kegg_sanity_run(kegg):
     ]
 )
 @flaky(max_runs=5)
-def test_kegg_run_cases(kegg, expected, case):
+async def test_kegg_run_cases(kegg, expected, case, recorded_llm):
     goal_template = ('{"query": "<query here>", '
                      '"explanation": "<explanation here>"}, '
                      '"query_result": "<result here or null for no result>"}')
-    r = kegg.run(case, goal_template=goal_template)
+    r = await kegg.run(case, goal_template=goal_template)
     response = json.loads(clean_markdown_response(r))
 
     if expected == 'retrieved':
@@ -49,3 +51,38 @@ def test_kegg_run_cases(kegg, expected, case):
         assert 'explanation' in response, 'Explanation is not present.'
         assert 'query_result' in response, 'Result is not present.'
         assert not response['query_result'], 'Query should not return any results.'
+
+
+def summary(contains_updates=False):
+    return MagicMock(**{'counters.contains_updates': contains_updates, 'counters.contains_system_updates': False})
+
+
+@patch('ha.tools.kegg.graphdb')
+def test_kegg_execute_query_caches_read_queries(mock_graphdb, kegg):
+    mock_graphdb.execute_query.return_value = ([{'name': 'DCC'}], summary())
+    kegg_module.QUERY_CACHE.clear()
+
+    first = kegg.execute_query("MATCH (n {name: 'DCC'}) RETURN n.name AS name")
+    first[0]['name'] = 'changed by the caller'
+    assert kegg.execute_query("MATCH (n {name: 'DCC'}) RETURN n.name AS name") == [{'name': 'DCC'}]
+    assert mock_graphdb.execute_query.call_count == 1
+
+    # queries that change the graph are always executed, whether they write with a clause or a procedure
+    mock_graphdb.execute_query.return_value = ([{'node': 1}], summary(contains_updates=True))
+    kegg.execute_query("MATCH (a {name: 'DCC'}), (b {name: 'dcc'}) CALL apoc.refactor.mergeNodes([a, b]) "
+                       "YIELD node RETURN id(node) AS node")
+    kegg.execute_query("MATCH (a {name: 'DCC'}), (b {name: 'dcc'}) CALL apoc.refactor.mergeNodes([a, b]) "
+                       "YIELD node RETURN id(node) AS node")
+    assert mock_graphdb.execute_query.call_count == 3
+
+
+def test_kegg_first_records_marks_truncated_results():
+    records = [MagicMock(**{'data.return_value': {'n': i}}) for i in range(kegg_module.MAX_RESULT_ROWS + 5)]
+    result = MagicMock(**{'__iter__.return_value': iter(records)})
+    data, _ = kegg_module._first_records(result)
+    assert len(data) == kegg_module.MAX_RESULT_ROWS + 1
+    assert data[-2] == {'n': kegg_module.MAX_RESULT_ROWS - 1}
+    assert data[-1]['truncated'].startswith(f'truncated after {kegg_module.MAX_RESULT_ROWS} of')
+
+    result = MagicMock(**{'__iter__.return_value': iter(records[:3])})
+    assert kegg_module._first_records(result)[0] == [{'n': 0}, {'n': 1}, {'n': 2}]
@@ -3,7 +3,7 @@ import pytest
 
 
 @pytest.mark.integration
-def test_plan_executor_sanity_run(plan_executor):
+async def test_plan_executor_sanity_run(plan_executor):
     plan = [
         {
             "tool": "kegg_query",
@@ -14,7 +14,7 @@ def test_plan_executor_sanity_run(plan_executor):
             "objective": "How many proteins are associated with the DCC gene?"
         }
     ]
-    response = plan_executor.run(plan=plan)
+    response = await plan_executor.run(plan=plan)
     assert response, 'The response is missing.'
     assert len(response) == len(plan), f'The response should have {len(plan)} items. It has {len(response)} items.'
     for i, item in enumerate(response):
@@ -60,8 +60,8 @@ def test_plan_executor_sanity_run(plan_executor):
     ]
 )
 @flaky(max_runs=5)
-def test_instructor_run_cases(plan_executor, plan):
-    response = plan_executor.run(plan=plan)
+async def test_instructor_run_cases(plan_executor, plan, recorded_llm):
+    response = await plan_executor.run(plan=plan)
     print(response)
     assert response, 'The response is missing.'
     assert len(response) == len(plan), f'The response should have {len(plan)} items. It has {len(response)} items.'
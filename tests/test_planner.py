@@ -5,12 +5,14 @@ import pytest
 
 
 @pytest.mark.integration
-def test_planner_sanity_run(planner, tool_registry, conversations):
-    response = planner.run(
+async def test_planner_sanity_run(planner, tool_registry, conversations):
+    response = await planner.run(
         conversation=conversations['BRCA1'],
         objective='Turn how you would go about answering the first question into a multi-step "plan"'
     )
     print(response)
+    assert response['objective'], 'The objective is missing.'
+    response = response['plan']
     assert response, 'The response is missing.'
     assert len(response) >= 1, f'The plan should have 3 steps. It has {len(response)} steps instead.'
     for i, item in enumerate(response):
@@ -31,12 +33,14 @@ def test_planner_sanity_run(planner, tool_registry, conversations):
     ]
 )
 @flaky(max_runs=5)
-def test_planner_run_cases(planner, tool_registry, conversations, conversation_name, objective):
+async def test_planner_run_cases(planner, tool_registry, conversations, conversation_name, objective, recorded_llm):
     conversation = conversations[conversation_name]
-    response = planner.run(
+    response = await planner.run(
         conversation=conversation,
         objective=objective
     )
+    assert response['objective'], 'The objective is missing.'
+    response = response['plan']
     assert response, 'The response is missing.'
     assert len(response) >= 1, f'The plan should have 3 steps. It has {len(response)} steps instead.'
     for i, item in enumerate(response):
@@ -0,0 +1,33 @@
+import time
+
+from ha.agent.rate_limit import RateLimiter
+
+
+async def timed_acquires(limiter, count, tokens=0):
+    start = time.monotonic()
+    for _ in range(count):
+        await limiter.acquire(tokens)
+    return time.monotonic() - start
+
+
+async def burst_then_more(limiter, count, tokens=0, more_tokens=0):
+    # the time limits are measured from the creation of the limiter, when its buckets are full
+    start = limiter._updated
+    await timed_acquires(limiter, count, tokens)
+    burst = time.monotonic() - start
+    await timed_acquires(limiter, 2, more_tokens)
+    return burst, time.monotonic() - start
+
+
+async def test_rate_limiter_spreads_requests_past_the_burst():
+    burst, total = await burst_then_more(RateLimiter(rpm=1200), 1200)
+    assert burst < 0.05
+    # one request every 50 ms once the bucket is empty
+    assert total >= 0.099
+
+
+async def test_rate_limiter_holds_back_large_requests():
+    burst, total = await burst_then_more(RateLimiter(rpm=0, tpm=6000), 1, tokens=6000, more_tokens=10)
+    assert burst < 0.05
+    # 100 tokens a second
+    assert total >= 0.199
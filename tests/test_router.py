@@ -0,0 +1,32 @@
+from ha.agent.router import KeywordRouter
+
+
+def test_router_sends_biomedical_turns_to_the_agent():
+    router = KeywordRouter()
+    assert router.route('What does PIK3CA do in insulin signaling?') == 'agent'
+    assert router.route('Which GO terms annotate INSR?') == 'agent'
+
+
+def test_router_answers_small_talk_and_defers_the_rest():
+    router = KeywordRouter()
+    assert router.route('Hello!') == 'answer'
+    assert router.route('Thank you, that was helpful') == 'answer'
+    assert router.route('Can you write me a short poem about the sea?') is None
+    assert router.route('In general, what should I generate next?') is None
+    # generic words alone do not force the agent
+    assert router.route('What is a gene, in simple words?') is None
+    assert router.route('What makes a good hypothesis?') is None
+    assert router.route('What is a receptor?') is None
+    assert router.route('What does a kinase do?') is None
+    assert router.route('Tell me about Jakarta') is None
+
+
+def test_router_matches_gene_symbols_not_words_that_start_like_them():
+    router = KeywordRouter()
+    assert router.route('Hi, I am Jake') == 'answer'
+    assert router.route('Thanks Jake!') == 'answer'
+    assert router.route('Does JAK2 activate STAT3?') == 'agent'
+    assert router.route('Is AKT1 downstream of PIK3CA?') == 'agent'
+    assert router.route('Is KRAS mutated in this tumour?') == 'agent'
+    assert router.route('Krasnodar is a city') is None
+    assert router.route('Aktuell news, please') is None
@@ -0,0 +1,32 @@
+import httpx
+import openai
+
+from ha import utils
+from ha.utils import generative_execution
+
+
+async def test_generative_execution_retries_unparseable_response_once():
+    calls = []
+
+    @generative_execution
+    async def generate():
+        calls.append(1)
+        raise ValueError('Failed to decode JSON response.')
+
+    assert await generate() == {'error': 'Failed to decode JSON response.'}
+    assert len(calls) == 2
+
+
+async def test_generative_execution_backs_off_on_timeouts(monkeypatch):
+    monkeypatch.setattr(utils, 'RETRY_BACKOFF', 0.0)
+    calls = []
+
+    @generative_execution
+    async def generate():
+        calls.append(1)
+        if len(calls) < 3:
+            raise openai.APITimeoutError(request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+        return 'ok'
+
+    assert await generate() == 'ok'
+    assert len(calls) == utils.RETRY_ATTEMPTS